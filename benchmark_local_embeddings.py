@@ -0,0 +1,94 @@
+import environ
+import sys
+import time
+import numpy as np
+from openai import OpenAI
+from pathlib import Path
+from sklearn.metrics.pairwise import cosine_similarity
+
+from utils.embeddings import get_embedding
+from utils.local_embeddings import load_local_embedder, get_local_embedding
+from utils.dynamic_prompt import load_examples
+
+# Import OpenAI key
+env = environ.Env()
+environ.Env.read_env()
+API_KEY = env("OPENAI_API_KEY")
+
+if API_KEY is None:
+    print("OpenAI API key is not set. Please set the API_KEY environment variable.")
+    sys.exit(1)
+
+# Client
+client_openai = OpenAI(api_key=API_KEY)
+
+# Embedding model
+EMB_MODEL = "text-embedding-3-small" # Embedding model
+
+# Path to embedding database and local embedder
+FOLDER = "./data_synthetic" # folder wiht generated synthetic data
+PATH_EMB_DB = Path(FOLDER, "embeddings.db")
+PATH_LOCAL_EMBEDDER = Path(FOLDER, "local_embedder.npz")
+# Number of example to use as few-shots in the prompt
+NUM_EXAMPLES_TO_SELECT = 5
+# Number of times each query is embedded to measure the latency
+N_REPEATS = 5
+
+# Queries not included in the synthetic data
+queries = [
+    "Your poor decisions regarding our child's health show your laziness, putting all the responsibility on me.",
+    "You never pay your share of the rent on time, I'm tired of covering for you.",
+    "Of course you forgot the pickup again, you only care about yourself.",
+    "Your mother calls every day to tell me how to raise my kids, and you just let her.",
+    "If you move to another city with the kids, you'll never see me again in court without a lawyer.",
+    "You spend every weekend with your friends and leave me alone with the chores.",
+    "I saw the messages on your phone, don't even try to lie to me.",
+    "You let them eat junk food all week at your place and I have to fix it.",
+    "Stop telling the kids I'm the reason they can't go on vacation.",
+    "You were drunk again at our son's birthday, you're a disgrace.",
+]
+
+
+def closest_ids(input_embedding:list, examples:dict, top_n:int) -> set:
+    similarities = cosine_similarity([input_embedding], examples["embeddings"])[0]
+    return set(examples["ids"][similarities.argsort()[-top_n:]].tolist())
+
+
+def time_embedding(embed, text:str, n_repeats:int) -> tuple[list, list]:
+    latencies = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        embedding = embed(text)
+        latencies.append(time.perf_counter() - start)
+    return embedding, latencies
+
+
+if __name__ == "__main__":
+
+    local_embedder = load_local_embedder(PATH_LOCAL_EMBEDDER)
+    remote_examples = load_examples(PATH_EMB_DB, embedding_column="embedding")
+    local_examples = load_examples(PATH_EMB_DB, embedding_column="local_embedding")
+
+    remote_latencies = []
+    local_latencies = []
+    overlaps = []
+
+    for text in queries:
+        remote_embedding, latencies = time_embedding(
+            lambda t: get_embedding(text=t, model=EMB_MODEL, client=client_openai), text, N_REPEATS)
+        remote_latencies += latencies
+
+        local_embedding, latencies = time_embedding(
+            lambda t: get_local_embedding(t, local_embedder), text, N_REPEATS)
+        local_latencies += latencies
+
+        # Fraction of the examples selected with the remote model also selected with the local one
+        remote_ids = closest_ids(remote_embedding, remote_examples, NUM_EXAMPLES_TO_SELECT)
+        local_ids = closest_ids(local_embedding, local_examples, NUM_EXAMPLES_TO_SELECT)
+        overlaps.append(len(remote_ids & local_ids) / NUM_EXAMPLES_TO_SELECT)
+
+    for name, latencies in [(EMB_MODEL, remote_latencies), ("local embedder", local_latencies)]:
+        p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+        print(f"{name}: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+    print(f"Neighbour overlap (top {NUM_EXAMPLES_TO_SELECT}): {np.mean(overlaps):.2f}")
@@ -1,31 +1,44 @@
-import environ
 import sys
-from openai import OpenAI
 from pathlib import Path
 from datetime import datetime
 
 from utils.dynamic_prompt import create_dynamic_prompt
+from utils.local_embeddings import load_local_embedder
 
-# Import OpenAI key
-env = environ.Env()
-environ.Env.read_env()
-API_KEY = env("OPENAI_API_KEY")
+# Embedding model
+EMB_MODEL = "text-embedding-3-small" # Embedding model
+EMBEDDER = "remote" # "remote" to embed the text with EMB_MODEL, "local" to use the local projection (no network)
 
-if API_KEY is None:
-    print("OpenAI API key is not set. Please set the API_KEY environment variable.")
-    sys.exit(1)
+# The OpenAI key and client are needed only to embed the text with EMB_MODEL
+if EMBEDDER == "remote":
+    import environ
+    from openai import OpenAI
 
-# Client
-client_openai = OpenAI(api_key=API_KEY)
+    # Import OpenAI key
+    env = environ.Env()
+    environ.Env.read_env()
+    API_KEY = env("OPENAI_API_KEY", default=None)
 
-# Embedding model
-EMB_MODEL = "text-embedding-3-small" # Embedding model
+    if API_KEY is None:
+        print("OpenAI API key is not set. Please set the API_KEY environment variable.")
+        sys.exit(1)
+
+    # Client
+    client_openai = OpenAI(api_key=API_KEY)
+else:
+    client_openai = None
 
 # Path to embedding database
 FOLDER = "./data_synthetic" # folder wiht generated synthetic data
 PATH_EMB_DB = Path(FOLDER, "embeddings.db")
+# Path to the local projection approximating EMB_MODEL
+PATH_LOCAL_EMBEDDER = Path(FOLDER, "local_embedder.npz")
 # Number of example to use as few-shots in the prompt
 NUM_EXAMPLES_TO_SELECT = 5
+# Issue categories in which to search the examples (None to search all of them)
+CATEGORIES = None
+# If no category is given, search only the categories with the closest centroids (None to search all of them)
+N_ROUTE_CATEGORIES = None
 
 # Folder to save the prompts
 PATH_PROMPTS = "dynamic_fewshot_prompts"
@@ -48,13 +61,19 @@ if __name__ == "__main__":
     
     print(f"This text will be added to the prompt:\n{text}")
 
+    local_embedder = load_local_embedder(PATH_LOCAL_EMBEDDER) if EMBEDDER == "local" else None
+
     print("Creating dynamic few-shot prompt...")
     dynamic_fewshot_prompt = create_dynamic_prompt(
         user_text=text,
         path_emb=PATH_EMB_DB,
         emb_model=EMB_MODEL,
         client=client_openai,
-        num_examples=NUM_EXAMPLES_TO_SELECT)
+        num_examples=NUM_EXAMPLES_TO_SELECT,
+        categories=CATEGORIES,
+        n_route_categories=N_ROUTE_CATEGORIES,
+        embedder=EMBEDDER,
+        local_embedder=local_embedder)
     
     current_time = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
     filename = f"prompt_{current_time}.txt"
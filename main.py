@@ -4,11 +4,15 @@ from openai import OpenAI
 from pathlib import Path
 
 from utils.issues_category import issues
-from utils.gen_data_openai import generate_data_openai
-from utils.gen_data_ollama import generate_data_ollama
+from utils.gen_data_openai import generate_data_openai, stream_issue_openai
+from utils.gen_data_ollama import generate_data_ollama, stream_issue_ollama
 from utils.gen_func_language import convert_functional_language, combine_and_save
-from utils.embeddings import get_all_embeddings, create_db, insert_embeddings
-from utils.load_save import import_json, save_files
+from utils.embeddings import get_all_embeddings, create_db, insert_embeddings, update_category_centroids
+from utils.load_save import import_json, import_parquet, save_files, save_parquet, add_source_model
+from utils.local_embeddings import train_local_embedder, insert_local_embeddings
+from utils.batch_jobs import generate_data_openai_batch, convert_functional_language_batch, get_all_embeddings_batch
+from utils.pipeline import run_streaming_pipeline
+from utils.planner import generate_to_target, stream_to_target
 
 # Import OpenAI key
 env = environ.Env()
@@ -28,22 +32,123 @@ TEMPERATURE = 0. # temperature for OpenAI model
 LLM_MODEL_OLLAMA = "dolphin-mistral" # Ollama model
 EMB_MODEL = "text-embedding-3-small" # Embedding model
 N_SENTENCES = 5 # Number of synthetic sentences generate for each issue
+MAX_SENTENCES_PER_REQUEST = 25 # Max number of sentences asked in a single request (larger targets are split)
+N_WORKERS_OPENAI = 4 # Number of concurrent requests to the OpenAI API
+N_WORKERS_OLLAMA = 1 # Number of concurrent requests to the local Ollama server
+STREAM = True # Stream the completions and re-run the model as soon as the output is not valid JSON
+BATCH = False # Use the OpenAI batch API (cheaper, but the jobs can take up to 24h) instead of one request at the time
+POLL_INTERVAL = 60 # Seconds between two checks of the status of a batch job
+N_CONVERT_WORKERS = 4 # Number of threads converting into functional language in the streaming pipeline
+SAVE_PARQUET = True # Save the datasets also as Parquet files (with the embeddings, once computed)
 FOLDER = "./data_synthetic" # Save here all the files
 
 # Path to synthetic data
 filename_openai = f"synthetic_data_{LLM_MODEL_OPENAI}"
 path_json_openai = Path(FOLDER, filename_openai + ".json")
 path_csv_openai = Path(FOLDER, filename_openai + ".csv")
+path_parquet_openai = Path(FOLDER, filename_openai + ".parquet") if SAVE_PARQUET else None
 #
 filename_ollama = f"synthetic_data_{LLM_MODEL_OLLAMA}"
 path_json_ollama = Path(FOLDER, filename_ollama + ".json")
 path_csv_ollama = Path(FOLDER, filename_ollama + ".csv")
+path_parquet_ollama = Path(FOLDER, filename_ollama + ".parquet") if SAVE_PARQUET else None
 #
 filename_synthetic_data = "synthetic_data"
 path_json_synthetic_data = Path(FOLDER, filename_synthetic_data + ".json")
 path_csv_synthetic_data = Path(FOLDER, filename_synthetic_data + ".csv")
+path_parquet_synthetic_data = Path(FOLDER, filename_synthetic_data + ".parquet") if SAVE_PARQUET else None
+path_parquet_embeddings = Path(FOLDER, filename_synthetic_data + "_embeddings.parquet")
 #
 path_db=Path(FOLDER, "embeddings.db")
+path_local_embedder=Path(FOLDER, "local_embedder.npz")
+
+
+def ask_streaming_pipeline():
+    prompt_string = (f"Run generation, conversion to functional text with {LLM_MODEL_OPENAI} "
+                     f"and embeddings with {EMB_MODEL} as a single streaming pipeline? (Y/N)")
+    ans = input(prompt_string)
+    return ans == "Y"
+
+
+def run_streaming(gen_openai:bool, gen_ollama:bool):
+    sources = {}
+    if gen_openai:
+        sources[LLM_MODEL_OPENAI] = stream_to_target(
+            issues=issues,
+            target=N_SENTENCES,
+            stream_issue=lambda issue, n, instructions: stream_issue_openai(
+                issue=issue,
+                n_sentences=n,
+                client=client_openai,
+                llm_model=LLM_MODEL_OPENAI,
+                temperature=TEMPERATURE,
+                instructions=instructions),
+            max_per_request=MAX_SENTENCES_PER_REQUEST)
+    if gen_ollama:
+        sources[LLM_MODEL_OLLAMA] = stream_to_target(
+            issues=issues,
+            target=N_SENTENCES,
+            stream_issue=lambda issue, n, instructions: stream_issue_ollama(
+                issue=issue,
+                n_sentences=n,
+                llm_model=LLM_MODEL_OLLAMA,
+                instructions=instructions),
+            max_per_request=MAX_SENTENCES_PER_REQUEST)
+    if not sources:
+        print("No model selected! Streaming pipeline skipped.")
+        return
+
+    # Build the database under a temporary name and rename it only at the end,
+    # so that a failed run does not leave a partial database blocking the next one
+    path_db_partial = path_db.with_name(path_db.stem + ".partial.db")
+    path_db_partial.unlink(missing_ok=True)
+    file_name_sql=Path("utils/create_bd.sql")
+    create_db(file_name_sql, path_db_partial)
+    print("SQL table created")
+
+    print(f"Start streaming pipeline with {' and '.join(sources)}")
+    source_errors = {}
+    embeddings = {}
+    results = run_streaming_pipeline(
+        sources=sources,
+        client=client_openai,
+        llm_model=LLM_MODEL_OPENAI,
+        temperature=TEMPERATURE,
+        emb_model=EMB_MODEL,
+        path_db=path_db_partial,
+        n_convert_workers=N_CONVERT_WORKERS,
+        source_errors=source_errors,
+        embeddings=embeddings)
+
+    if not any(results.values()):
+        print("No sentence generated! The database and the files are not saved.")
+        path_db_partial.unlink()
+        return
+    for name in source_errors:
+        print(f"{name} stopped early: {len(results[name])} sentences kept")
+
+    print("Storing data into files...")
+    if results.get(LLM_MODEL_OPENAI):
+        save_files(results[LLM_MODEL_OPENAI], path_json_openai, path_csv_openai, path_parquet_openai, LLM_MODEL_OPENAI)
+    if results.get(LLM_MODEL_OLLAMA):
+        save_files(results[LLM_MODEL_OLLAMA], path_json_ollama, path_csv_ollama, path_parquet_ollama, LLM_MODEL_OLLAMA)
+    combine_and_save(
+        results.get(LLM_MODEL_OPENAI, []),
+        results.get(LLM_MODEL_OLLAMA, []),
+        path_json_synthetic_data,
+        path_csv_synthetic_data,
+        path_parquet_synthetic_data,
+        (LLM_MODEL_OPENAI, LLM_MODEL_OLLAMA))
+    if SAVE_PARQUET:
+        print("Saving combined data and embeddings into a parquet file")
+        save_parquet(
+            [row for name in results for row in add_source_model(results[name], name)],
+            path_parquet_embeddings,
+            [emb for name in results for emb in embeddings[name]])
+
+    print("Computing the centroid of each issue category")
+    update_category_centroids(path_db_partial)
+    path_db_partial.replace(path_db)
 
 
 def ask_gen_data_gpt():
@@ -70,33 +175,75 @@ def ask_emb_sql():
     return ans == "Y"
 
 
+def ask_local_embedder():
+    prompt_string = f"Train a local embedder approximating {EMB_MODEL} and re-embed the SQL database? (Y/N)"
+    ans = input(prompt_string)
+    return ans == "Y"
+
+
 if __name__ == "__main__":
 
-    gen_openai = ask_gen_data_gpt()
+    # The streaming pipeline creates the database, check it does not exist before asking
+    if path_db.exists():
+        print(f"{path_db} already exists! Streaming pipeline skipped.")
+        streaming = False
+    else:
+        streaming = ask_streaming_pipeline()
+    if streaming:
+        # The models to run in the pipeline, the steps below are done by the pipeline
+        run_streaming(ask_gen_data_gpt(), ask_gen_data_ollama())
+
+    gen_openai = not streaming and ask_gen_data_gpt()
     if gen_openai:
         print(f"Start generating synthetic data with {LLM_MODEL_OPENAI}")
-        response = generate_data_openai(
-            issues=issues,
-            n_sentences=N_SENTENCES,
-            client=client_openai,
-            llm_model=LLM_MODEL_OPENAI,
-            temperature=TEMPERATURE)
-        print(f"Number of sentences generated: {len(issues) * N_SENTENCES}")
+        if BATCH:
+            response = generate_data_openai_batch(
+                issues=issues,
+                n_sentences=N_SENTENCES,
+                client=client_openai,
+                llm_model=LLM_MODEL_OPENAI,
+                temperature=TEMPERATURE,
+                folder=FOLDER,
+                poll_interval=POLL_INTERVAL,
+                max_per_request=MAX_SENTENCES_PER_REQUEST,
+                max_workers=N_WORKERS_OPENAI)
+        else:
+            response = generate_to_target(
+                issues=issues,
+                target=N_SENTENCES,
+                generate=lambda issue, n, instructions: generate_data_openai(
+                    issues=[issue],
+                    n_sentences=n,
+                    client=client_openai,
+                    llm_model=LLM_MODEL_OPENAI,
+                    temperature=TEMPERATURE,
+                    stream=STREAM,
+                    instructions=instructions),
+                max_per_request=MAX_SENTENCES_PER_REQUEST,
+                max_workers=N_WORKERS_OPENAI)
+        print(f"Number of sentences generated: {len(response)}")
         print("Storing data into files...")
-        save_files(response, path_json_openai, path_csv_openai)
+        save_files(response, path_json_openai, path_csv_openai, path_parquet_openai, LLM_MODEL_OPENAI)
     
-    gen_ollama = ask_gen_data_ollama()
+    gen_ollama = not streaming and ask_gen_data_ollama()
     if gen_ollama:
         print(f"Start generating synthetic data with {LLM_MODEL_OLLAMA}")
-        response = generate_data_ollama(
+        response = generate_to_target(
             issues=issues,
-            n_sentences=N_SENTENCES,
-            llm_model=LLM_MODEL_OLLAMA)
-        print(f"Number of sentences generated: {len(issues) * N_SENTENCES}")
+            target=N_SENTENCES,
+            generate=lambda issue, n, instructions: generate_data_ollama(
+                issues=[issue],
+                n_sentences=n,
+                llm_model=LLM_MODEL_OLLAMA,
+                stream=STREAM,
+                instructions=instructions),
+            max_per_request=MAX_SENTENCES_PER_REQUEST,
+            max_workers=N_WORKERS_OLLAMA)
+        print(f"Number of sentences generated: {len(response)}")
         print("Storing data into files...")
-        save_files(response, path_json_ollama, path_csv_ollama)
+        save_files(response, path_json_ollama, path_csv_ollama, path_parquet_ollama, LLM_MODEL_OLLAMA)
     
-    funct_text = ask_functional_text()
+    funct_text = not streaming and ask_functional_text()
     if funct_text:
 
         print(f"Loading synthetic data denerated with {LLM_MODEL_OPENAI}")
@@ -104,24 +251,43 @@ if __name__ == "__main__":
         print(f"Loading synthetic data denerated with {LLM_MODEL_OLLAMA}")
         syn_data_dolphin = import_json(path_json_ollama)
 
-        print(f"Converting to functional language dataset created with {LLM_MODEL_OPENAI}")
-        functional_gpt = convert_functional_language(
-            syn_data_gpt,
-            client_openai,
-            LLM_MODEL_OPENAI,
-            TEMPERATURE)
-        
-        print(f"Converting to functional language dataset created with {LLM_MODEL_OLLAMA}")
-        functional_dolphin = convert_functional_language(
-            syn_data_dolphin,
-            client_openai,
-            LLM_MODEL_OPENAI,
-            TEMPERATURE)
+        if BATCH:
+            # Convert both datasets with a single batch job
+            print(f"Converting to functional language datasets created with {LLM_MODEL_OPENAI} and {LLM_MODEL_OLLAMA}")
+            functional = convert_functional_language_batch(
+                syn_data_gpt + syn_data_dolphin,
+                client_openai,
+                LLM_MODEL_OPENAI,
+                TEMPERATURE,
+                FOLDER,
+                POLL_INTERVAL)
+            functional_gpt = functional[:len(syn_data_gpt)]
+            functional_dolphin = functional[len(syn_data_gpt):]
+        else:
+            print(f"Converting to functional language dataset created with {LLM_MODEL_OPENAI}")
+            functional_gpt = convert_functional_language(
+                syn_data_gpt,
+                client_openai,
+                LLM_MODEL_OPENAI,
+                TEMPERATURE)
+
+            print(f"Converting to functional language dataset created with {LLM_MODEL_OLLAMA}")
+            functional_dolphin = convert_functional_language(
+                syn_data_dolphin,
+                client_openai,
+                LLM_MODEL_OPENAI,
+                TEMPERATURE)
         
         print(f"Combining {LLM_MODEL_OPENAI} and {LLM_MODEL_OLLAMA} datasets and save into json and csv files")
-        combine_and_save(functional_gpt, functional_dolphin, path_json_synthetic_data, path_csv_synthetic_data)
+        combine_and_save(
+            functional_gpt,
+            functional_dolphin,
+            path_json_synthetic_data,
+            path_csv_synthetic_data,
+            path_parquet_synthetic_data,
+            (LLM_MODEL_OPENAI, LLM_MODEL_OLLAMA))
     
-    emb_sql = ask_emb_sql()
+    emb_sql = not streaming and ask_emb_sql()
     if emb_sql:
         file_name_sql=Path("utils/create_bd.sql")
         file_name_bd=Path(FOLDER, "embeddings.db")
@@ -129,13 +295,26 @@ if __name__ == "__main__":
         print("SQL table created")
 
         print(f"Loading combined data generated with {LLM_MODEL_OPENAI} and {LLM_MODEL_OLLAMA}")
-        synthetic_data = import_json(path_json_synthetic_data)
+        # The json file is read instead if it was edited by hand after the parquet file was saved
+        if (SAVE_PARQUET and path_parquet_synthetic_data.exists()
+                and path_parquet_synthetic_data.stat().st_mtime >= path_json_synthetic_data.stat().st_mtime):
+            synthetic_data, _ = import_parquet(path_parquet_synthetic_data)
+        else:
+            synthetic_data = import_json(path_json_synthetic_data)
 
         print(f"Getting embedding for the synthetic data with {EMB_MODEL}")
-        emb_synthetic_data = get_all_embeddings(
-            data=synthetic_data,
-            model=EMB_MODEL,
-            client=client_openai)
+        if BATCH:
+            emb_synthetic_data = get_all_embeddings_batch(
+                data=synthetic_data,
+                model=EMB_MODEL,
+                client=client_openai,
+                folder=FOLDER,
+                poll_interval=POLL_INTERVAL)
+        else:
+            emb_synthetic_data = get_all_embeddings(
+                data=synthetic_data,
+                model=EMB_MODEL,
+                client=client_openai)
         
         print(f"Number of vector embeddings: {len(emb_synthetic_data)}")
         print(f"Length of the vector embedding: {len(emb_synthetic_data[0])}")
@@ -145,5 +324,20 @@ if __name__ == "__main__":
             data=synthetic_data,
             embeddings=emb_synthetic_data,
             path_db=path_db)
+
+        print("Computing the centroid of each issue category")
+        update_category_centroids(path_db)
+
+        if SAVE_PARQUET:
+            print("Saving combined data and embeddings into a parquet file")
+            save_parquet(synthetic_data, path_parquet_embeddings, emb_synthetic_data)
+
+    local_emb = ask_local_embedder()
+    if local_emb:
+        print(f"Training the local embedder on the {EMB_MODEL} embeddings")
+        local_embedder = train_local_embedder(path_db, path_local_embedder)
+
+        print("Inserting local embeddings in the sql table")
+        insert_local_embeddings(path_db, local_embedder)
         
-        print("ALL DONE!")
+    print("ALL DONE!")
@@ -0,0 +1,112 @@
+import argparse
+import os
+import socket
+import sys
+from pathlib import Path
+
+from utils.issues_category import issues
+from utils.job_queue import create_queue, run_worker, queue_status, merge_results
+from utils.load_save import save_files
+
+FOLDER = "./data_synthetic" # Save here all the files
+PATH_QUEUE = Path(FOLDER, "job_queue.db")
+TEMPERATURE = 0. # temperature for OpenAI model
+
+
+def make_generate(backend:str, endpoint:str, model:str):
+    """
+    Return the function generating the sentences of a job with the given backend and endpoint.
+    """
+    if backend == "ollama":
+        import ollama
+        from utils.gen_data_ollama import generate_data_ollama
+
+        client = ollama.Client(host=endpoint) if endpoint else None
+        return lambda issue, n: generate_data_ollama([issue], n, model, stream=True, client=client)
+
+    import environ
+    from openai import OpenAI
+    from utils.gen_data_openai import generate_data_openai
+
+    env = environ.Env()
+    environ.Env.read_env()
+    api_key = env("OPENAI_API_KEY", default=None)
+    if api_key is None:
+        print("OpenAI API key is not set. Please set the API_KEY environment variable.")
+        sys.exit(1)
+
+    client = OpenAI(api_key=api_key, base_url=endpoint) if endpoint else OpenAI(api_key=api_key)
+    return lambda issue, n: generate_data_openai([issue], n, client, model, TEMPERATURE, stream=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Job queue for the generation of synthetic data")
+    parser.add_argument("--queue", type=Path, default=PATH_QUEUE, help="Path to the .db file of the queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_init = subparsers.add_parser("init", help="Create the queue with a job for each batch of each issue")
+    parser_init.add_argument("--n-sentences", type=int, default=5, help="Number of sentences for each issue")
+    parser_init.add_argument("--batch-size", type=int, default=5, help="Max number of sentences for each job")
+    parser_init.add_argument("--reset", action="store_true", help="Delete the jobs and results of an existing queue")
+
+    parser_work = subparsers.add_parser("work", help="Run jobs until the queue is empty")
+    parser_work.add_argument("--backend", choices=["ollama", "openai"], required=True)
+    parser_work.add_argument("--endpoint", default=None, help="URL of the Ollama server or of the OpenAI API")
+    parser_work.add_argument("--model", required=True, help="Name of the model")
+    parser_work.add_argument("--worker", default=f"{socket.gethostname()}-{os.getpid()}", help="Name of the worker")
+    parser_work.add_argument("--lease-seconds", type=float, default=300)
+    parser_work.add_argument("--heartbeat-interval", type=float, default=60)
+    parser_work.add_argument("--max-attempts", type=int, default=3)
+
+    parser_merge = subparsers.add_parser(
+        "merge", help="Merge the results into the files synthetic_data_<model>.json/.csv read by main.py")
+    parser_merge.add_argument("--parquet", action="store_true", help="Save also a parquet file for each model")
+
+    subparsers.add_parser("status", help="Print the number of jobs in each status")
+
+    args = parser.parse_args()
+
+    if args.command == "init":
+        try:
+            n_jobs = create_queue(args.queue, issues, args.n_sentences, args.batch_size, reset=args.reset)
+        except RuntimeError as error:
+            print(f"{error} Use --reset to delete its jobs and results and create them again.")
+            sys.exit(1)
+        print(f"{n_jobs} jobs added to the queue {args.queue}")
+
+    elif args.command == "work":
+        n_done = run_worker(
+            path_queue=args.queue,
+            worker=args.worker,
+            generate=make_generate(args.backend, args.endpoint, args.model),
+            model=args.model,
+            lease_seconds=args.lease_seconds,
+            heartbeat_interval=args.heartbeat_interval,
+            max_attempts=args.max_attempts)
+        print(f"Worker {args.worker} completed {n_done} jobs")
+
+    elif args.command == "status":
+        print(queue_status(args.queue))
+
+    elif args.command == "merge":
+        status = queue_status(args.queue)
+        if status.get("pending", 0) or status.get("leased", 0):
+            print(f"Some jobs are not finished yet: {status}")
+        responses = merge_results(args.queue)
+        print(f"Number of sentences generated: {len(responses)}")
+        if not responses:
+            sys.exit(0)
+        # One set of files for each model, with the names used by main.py for the conversion step
+        responses_model = {}
+        for row in responses:
+            responses_model.setdefault(row["model"], []).append(row)
+        for model, rows in responses_model.items():
+            print(f"Storing {len(rows)} sentences of {model} into files...")
+            filename = f"synthetic_data_{model}"
+            save_files(
+                rows,
+                Path(FOLDER, filename + ".json"),
+                Path(FOLDER, filename + ".csv"),
+                Path(FOLDER, filename + ".parquet") if args.parquet else None,
+                model)
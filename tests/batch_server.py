@@ -0,0 +1,249 @@
+import json
+import threading
+import time
+import urllib.request
+import uuid
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class BatchServer:
+    """
+    Local stand-in for the files and batches endpoints of the OpenAI API, to run the batch
+    stages without a real account:
+        POST /v1/files                 upload a request file
+        GET  /v1/files/{id}/content    download a file
+        POST /v1/batches               create a batch job
+        GET  /v1/batches/{id}          retrieve a batch job
+        POST /v1/chat/completions      synchronous request, used for the rows re-run one by one
+        POST /v1/embeddings            synchronous request, used for the rows re-run one by one
+
+    The requests of a batch job are answered with 'respond', a function taking the body of
+    a request and returning the body of the response, and the synchronous requests with
+    'respond_sync' ('respond' if not given). A job is "in_progress" for the first
+    'n_polls' retrievals, then it ends with 'final_status'. With a status other than "completed",
+    only the first 'n_completed' requests are written into the output file.
+    The bodies of the synchronous requests are recorded in 'sync_requests'.
+
+    Use it with the OpenAI client:
+        with BatchServer(respond) as server:
+            client = OpenAI(base_url=server.base_url, api_key="test")
+    """
+
+    def __init__(self, respond, n_polls:int=1, final_status:str="completed", n_completed:int=0, respond_sync=None):
+        self.respond = respond
+        self.respond_sync = respond_sync or respond
+        self.sync_requests = []
+        self.n_polls = n_polls
+        self.final_status = final_status
+        self.n_completed = n_completed
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_file(self, content:bytes, filename:str, purpose:str) -> dict:
+        with self.lock:
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+                "content": content
+            }
+        return self.files[file_id]
+
+    def create_batch(self, body:dict) -> dict:
+        with self.lock:
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "status": "validating",
+                "output_file_id": None,
+                "error_file_id": None,
+                "created_at": int(time.time()),
+                "polls": 0
+            }
+        return self.batches[batch_id]
+
+    def retrieve_batch(self, batch_id:str) -> dict:
+        batch = self.batches[batch_id]
+        with self.lock:
+            batch["polls"] += 1
+            if batch["polls"] <= self.n_polls:
+                batch["status"] = "in_progress"
+            elif batch["output_file_id"] is None:
+                batch["status"] = self.final_status
+                self._run(batch)
+        return batch
+
+    def _run(self, batch:dict):
+        lines = self.files[batch["input_file_id"]]["content"].decode().splitlines()
+        if batch["status"] != "completed":
+            lines = lines[:self.n_completed]
+        if batch["status"] == "failed" or not lines:
+            return
+
+        output = ""
+        for line in lines:
+            request = json.loads(line)
+            output += json.dumps({
+                "id": f"response-{request['custom_id']}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": self.respond(request["body"])},
+                "error": None
+            }) + "\n"
+
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = {"id": file_id, "content": output.encode()}
+        batch["output_file_id"] = file_id
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/v1/files":
+                    # Multipart form with the fields 'purpose' and 'file'
+                    message = BytesParser(policy=email_policy).parsebytes(
+                        b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+                    fields = {part.get_param("name", header="content-disposition"): part
+                              for part in message.iter_parts()}
+                    file = server.add_file(
+                        fields["file"].get_payload(decode=True),
+                        fields["file"].get_filename(),
+                        fields["purpose"].get_content().strip())
+                    self._send_json({k: v for k, v in file.items() if k != "content"})
+                elif self.path == "/v1/batches":
+                    self._send_json(self._public(server.create_batch(json.loads(body))))
+                elif self.path in ("/v1/chat/completions", "/v1/embeddings"):
+                    body = json.loads(body)
+                    server.sync_requests.append(body)
+                    self._send_json(server.respond_sync(body))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in server.batches:
+                    self._send_json(self._public(server.retrieve_batch(parts[2])))
+                elif parts[:2] == ["v1", "files"] and parts[3:] == ["content"] and parts[2] in server.files:
+                    self._send(server.files[parts[2]]["content"], "application/octet-stream")
+                else:
+                    self.send_error(404)
+
+            def _public(self, batch:dict) -> dict:
+                return {k: v for k, v in batch.items() if k != "polls"}
+
+            def _send_json(self, obj:dict):
+                self._send(json.dumps(obj).encode(), "application/json")
+
+            def _send(self, content:bytes, content_type:str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def chat_response(content) -> dict:
+    """
+    Body of a chat completion with the given content (None for a null content, e.g. a filtered completion).
+    """
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "test-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+    }
+
+
+def embedding_response(embeddings:list) -> dict:
+    """
+    Body of an embeddings response with the given vectors.
+    """
+    return {
+        "object": "list",
+        "model": "test-model",
+        "data": [{"object": "embedding", "index": i, "embedding": emb} for i, emb in enumerate(embeddings)],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0}
+    }
+
+
+def _namespace(obj):
+    if isinstance(obj, dict):
+        return SimpleNamespace(**{k: _namespace(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return [_namespace(v) for v in obj]
+    return obj
+
+
+class BatchClient:
+    """
+    Minimal client for 'BatchServer' with the methods of the OpenAI client used by the repository
+    (files, batches, chat completions and embeddings), for running the tests when the openai package
+    is not installed.
+    """
+
+    def __init__(self, base_url:str):
+        self.base_url = base_url
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(
+            create=lambda **body: _namespace(self._post_json("/batches", body)),
+            retrieve=lambda batch_id: _namespace(self._get(f"/batches/{batch_id}", json_response=True)))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **body: _namespace(self._post_json("/chat/completions", body))))
+        self.embeddings = SimpleNamespace(
+            create=lambda **body: _namespace(self._post_json("/embeddings", body)))
+
+    def _create_file(self, file, purpose:str):
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\n{purpose}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="requests.jsonl"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode() + file.read() + f'\r\n--{boundary}--\r\n'.encode()
+        request = urllib.request.Request(
+            self.base_url + "/files", data=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        with urllib.request.urlopen(request) as response:
+            return _namespace(json.load(response))
+
+    def _file_content(self, file_id:str):
+        return SimpleNamespace(text=self._get(f"/files/{file_id}/content").decode())
+
+    def _post_json(self, path:str, body:dict) -> dict:
+        request = urllib.request.Request(
+            self.base_url + path, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+
+    def _get(self, path:str, json_response:bool=False):
+        with urllib.request.urlopen(self.base_url + path) as response:
+            return json.load(response) if json_response else response.read()
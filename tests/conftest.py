@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Run the tests against the modules of the repository, e.g. 'utils.batch_jobs'
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
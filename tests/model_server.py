@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ModelServer:
+    """
+    Local stand-in for a model server, answering the streaming generation requests of the workers:
+        POST /api/generate             Ollama generation, streamed as JSON lines
+        POST /v1/chat/completions      OpenAI chat completion, streamed as server-sent events
+
+    The text of a response is given by 'respond', a function taking the prompt and returning a string,
+    and it is sent in chunks of 'chunk_size' characters. The bodies of the requests are recorded in 'requests'.
+
+    Use it with the Ollama client or the OpenAI client:
+        with ModelServer(respond) as server:
+            client = ollama.Client(host=server.url)
+            client = OpenAI(base_url=server.url + "/v1", api_key="test")
+    """
+
+    def __init__(self, respond, chunk_size:int=7):
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.requests = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def chunks(self, prompt:str) -> list:
+        text = self.respond(prompt)
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                if self.path == "/api/generate":
+                    self._stream_ollama(body)
+                elif self.path == "/v1/chat/completions":
+                    self._stream_openai(body)
+                else:
+                    self.send_error(404)
+
+            def _stream_ollama(self, body:dict):
+                lines = [{"model": body["model"], "created_at": "", "response": chunk, "done": False}
+                         for chunk in server.chunks(body["prompt"])]
+                lines.append({"model": body["model"], "created_at": "", "response": "", "done": True})
+                self._send("".join(json.dumps(line) + "\n" for line in lines), "application/x-ndjson")
+
+            def _stream_openai(self, body:dict):
+                chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+                deltas = [{"role": "assistant", "content": chunk} for chunk in server.chunks(body["messages"][-1]["content"])]
+                events = ""
+                for i, delta in enumerate(deltas + [{}]):
+                    events += "data: " + json.dumps({
+                        "id": chunk_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body["model"],
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": None if i < len(deltas) else "stop"}]
+                    }) + "\n\n"
+                events += "data: [DONE]\n\n"
+                self._send(events, "text/event-stream")
+
+            def _send(self, content:str, content_type:str):
+                # No Content-Length: the client reads the stream until the connection is closed
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for line in content.splitlines(keepends=True):
+                    self.wfile.write(line.encode())
+                    self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,189 @@
+import json
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from utils.batch_jobs import (embedding_request, run_batch, generate_data_openai_batch,
+                              convert_functional_language_batch, get_all_embeddings_batch)
+from utils.embeddings import create_db, insert_embeddings
+from batch_server import BatchServer, BatchClient, chat_response, embedding_response
+
+FILE_NAME_SQL = Path(__file__).resolve().parents[1] / "utils" / "create_bd.sql"
+
+
+def make_client(server:BatchServer):
+    """
+    The OpenAI client pointing to the stand-in server, or 'BatchClient' if openai is not installed.
+    """
+    try:
+        from openai import OpenAI
+    except ImportError:
+        return BatchClient(server.base_url)
+    return OpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+
+
+def respond(body:dict) -> dict:
+    """
+    Answer the requests of the pipeline: embeddings of length 1 with the length of the text,
+    generated sentences, and a functional version. Prompts containing "FILTERED" get a null content.
+    """
+    if "input" in body:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return embedding_response([[float(len(text))] for text in texts])
+    prompt = body["messages"][0]["content"]
+    if "FILTERED" in prompt:
+        return chat_response(None)
+    if "Provide" in prompt:
+        return chat_response(json.dumps([{"dysfunctional": "a generated sentence"}]))
+    return chat_response("a functional version")
+
+
+def respond_sync(body:dict) -> dict:
+    """
+    Same as 'respond', but the re-run requests are never filtered.
+    """
+    if "messages" in body and "Provide" in body["messages"][0]["content"]:
+        return chat_response(json.dumps([{"dysfunctional": "a re-run sentence"}]))
+    if "messages" in body:
+        return chat_response("a re-run functional version")
+    return respond(body)
+
+
+def make_requests(texts:list) -> list:
+    return [embedding_request(f"row-{i}", text, "test-model") for i, text in enumerate(texts)]
+
+
+def test_run_batch_local_server(tmp_path):
+    with BatchServer(respond, n_polls=2) as server:
+        results = run_batch(make_client(server), make_requests(["a", "bb", "ccc"]), "/v1/embeddings", tmp_path,
+                            "embeddings", 0)
+
+    assert {k: v["data"][0]["embedding"] for k, v in results.items()} == {"row-0": [1.0], "row-1": [2.0], "row-2": [3.0]}
+    assert not (tmp_path / "batch_embeddings_state.json").exists()
+
+
+def test_run_batch_expired_returns_partial_results(tmp_path):
+    with BatchServer(respond, final_status="expired", n_completed=2) as server:
+        results = run_batch(make_client(server), make_requests(["a", "bb", "ccc"]), "/v1/embeddings", tmp_path,
+                            "embeddings", 0)
+
+    assert sorted(results) == ["row-0", "row-1"]
+    assert not (tmp_path / "batch_embeddings_state.json").exists()
+
+
+def test_run_batch_failed_removes_state(tmp_path):
+    with BatchServer(respond, final_status="failed") as server:
+        with pytest.raises(RuntimeError):
+            run_batch(make_client(server), make_requests(["a"]), "/v1/embeddings", tmp_path, "embeddings", 0)
+
+    assert not (tmp_path / "batch_embeddings_state.json").exists()
+
+
+def test_run_batch_resumes_the_submitted_job(tmp_path, monkeypatch):
+    requests = make_requests(["a", "bb"])
+
+    with BatchServer(respond, n_polls=2) as server:
+        # The process dies while polling the job it submitted
+        crashed_client = make_client(server)
+
+        def crash(batch_id):
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(crashed_client.batches, "retrieve", crash)
+        with pytest.raises(KeyboardInterrupt):
+            run_batch(crashed_client, requests, "/v1/embeddings", tmp_path, "embeddings", 0)
+        assert (tmp_path / "batch_embeddings_state.json").exists()
+
+        # The next run polls the same job, without uploading or submitting anything
+        results = run_batch(make_client(server), requests, "/v1/embeddings", tmp_path, "embeddings", 0)
+
+        assert len(server.batches) == 1
+        assert [f for f in server.files.values() if f.get("purpose") == "batch"] == [server.files["file-0"]]
+
+    assert sorted(results) == ["row-0", "row-1"]
+    assert not (tmp_path / "batch_embeddings_state.json").exists()
+
+
+def test_run_batch_refuses_to_resume_other_requests(tmp_path):
+    path_state = tmp_path / "batch_embeddings_state.json"
+    path_state.write_text(json.dumps({
+        "batch_id": "batch-0",
+        "endpoint": "/v1/embeddings",
+        "requests_hash": "hash of other requests",
+        "n_requests": 3
+    }))
+
+    # The state is checked before any call to the API
+    with pytest.raises(RuntimeError, match="different requests"):
+        run_batch(None, make_requests(["a", "bb", "ccc"]), "/v1/embeddings", tmp_path, "embeddings", 0)
+
+    assert path_state.exists()
+
+
+def test_generate_data_openai_batch_reruns_null_content(tmp_path):
+    with BatchServer(respond, respond_sync=respond_sync) as server:
+        responses = generate_data_openai_batch(
+            ["money", "FILTERED issue"], 1, make_client(server), "test-model", 0., tmp_path, 0)
+
+    assert responses == [
+        {"dysfunctional": "a generated sentence", "category": "money"},
+        {"dysfunctional": "a re-run sentence", "category": "FILTERED issue"}
+    ]
+
+
+def test_convert_functional_language_batch_reruns_missing_and_null_rows(tmp_path):
+    data = [
+        {"dysfunctional": "first", "category": "money"},
+        {"dysfunctional": "FILTERED", "category": "kids"},
+        {"dysfunctional": "third", "category": "money"}
+    ]
+    # The job expires after the first two rows: the second is null, the third is missing
+    with BatchServer(respond, final_status="expired", n_completed=2, respond_sync=respond_sync) as server:
+        paired = convert_functional_language_batch(data, make_client(server), "test-model", 0., tmp_path, 0)
+        assert len(server.sync_requests) == 2
+
+    assert paired == [
+        {"dysfunctional": "first", "functional": "a functional version", "category": "money"},
+        {"dysfunctional": "FILTERED", "functional": "a re-run functional version", "category": "kids"},
+        {"dysfunctional": "third", "functional": "a re-run functional version", "category": "money"}
+    ]
+
+
+def test_get_all_embeddings_batch_can_be_inserted(tmp_path):
+    data = [
+        {"dysfunctional": "a", "functional": "f", "category": "money"},
+        {"dysfunctional": "bb", "functional": "f", "category": "money"},
+        {"dysfunctional": "ccc", "functional": "f", "category": "kids"}
+    ]
+    with BatchServer(respond, final_status="expired", n_completed=1) as server:
+        embeddings = get_all_embeddings_batch(data, "test-model", make_client(server), tmp_path, 0)
+        assert len(server.sync_requests) == 2
+
+    assert embeddings == [[1.0], [2.0], [3.0]]
+
+    path_db = tmp_path / "embeddings.db"
+    create_db(FILE_NAME_SQL, path_db)
+    insert_embeddings(data, embeddings, path_db)
+    con = sqlite3.connect(path_db)
+    rows = con.execute("SELECT dysfunctional, embedding, category FROM examples ORDER BY id").fetchall()
+    con.close()
+    assert rows == [("a", "[1.0]", "money"), ("bb", "[2.0]", "money"), ("ccc", "[3.0]", "kids")]
+
+
+def test_generate_data_openai_batch_splits_requests_and_tops_up_duplicates(tmp_path):
+    with BatchServer(respond, respond_sync=respond_sync) as server:
+        responses = generate_data_openai_batch(
+            ["money"], 2, make_client(server), "test-model", 0., tmp_path, 0, max_per_request=1)
+        batch_requests = [json.loads(line) for line in server.files["file-0"]["content"].decode().splitlines()]
+
+    # One request for each sentence, the second with a focus
+    assert [request["custom_id"] for request in batch_requests] == ["issue-0-0", "issue-0-1"]
+    prompts = [request["body"]["messages"][0]["content"] for request in batch_requests]
+    assert "Focus mostly on" not in prompts[0] and "Focus mostly on" in prompts[1]
+
+    # Both requests return the same sentence: the missing one is generated with a synchronous request
+    assert responses == [
+        {"dysfunctional": "a generated sentence", "category": "money"},
+        {"dysfunctional": "a re-run sentence", "category": "money"}
+    ]
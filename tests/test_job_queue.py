@@ -0,0 +1,136 @@
+import json
+import multiprocessing
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from utils.job_queue import create_queue, lease_job, run_worker, queue_status, merge_results
+from model_server import ModelServer
+
+ROOT = Path(__file__).resolve().parents[1]
+FILE_NAME_SQL = ROOT / "utils" / "create_queue.sql"
+
+
+def fake_generate(issue:str, n:int) -> list:
+    time.sleep(0.02)
+    return [{"dysfunctional": f"{issue} {i}", "category": issue} for i in range(n)]
+
+
+def work(path_queue:Path, worker:str):
+    run_worker(path_queue, worker, fake_generate, "fake-model", lease_seconds=30, heartbeat_interval=1,
+               poll_interval=0.1)
+
+
+def test_workers_in_separate_processes_run_each_job_once(tmp_path):
+    path_queue = tmp_path / "job_queue.db"
+    issues = [f"issue {i}" for i in range(10)]
+    n_jobs = create_queue(path_queue, issues, n_sentences=12, batch_size=5, file_name_sql=FILE_NAME_SQL)
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=work, args=(path_queue, f"worker-{i}")) for i in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert queue_status(path_queue) == {"done": n_jobs}
+
+    # Every job stored its sentences exactly once
+    con = sqlite3.connect(path_queue)
+    counts = con.execute(
+        "SELECT jobs.n_sentences, COUNT(results.id) FROM jobs LEFT JOIN results ON results.job_id = jobs.id "
+        "GROUP BY jobs.id").fetchall()
+    con.close()
+    assert all(n_sentences == n_results for n_sentences, n_results in counts)
+
+    results = merge_results(path_queue)
+    assert len(results) == 12 * len(issues)
+    assert {row["category"] for row in results} == set(issues)
+
+
+def test_job_of_a_dead_worker_is_leased_again(tmp_path):
+    path_queue = tmp_path / "job_queue.db"
+    create_queue(path_queue, ["issue"], n_sentences=3, batch_size=5, file_name_sql=FILE_NAME_SQL)
+
+    # A worker leases the job and dies without renewing the lease
+    assert lease_job(path_queue, "dead-worker", lease_seconds=0) is not None
+
+    assert run_worker(path_queue, "worker", fake_generate, "fake-model", poll_interval=0.1) == 1
+    assert queue_status(path_queue) == {"done": 1}
+
+
+def test_a_queue_with_jobs_is_not_filled_again(tmp_path):
+    path_queue = tmp_path / "job_queue.db"
+    assert create_queue(path_queue, ["a", "b"], n_sentences=3, batch_size=5, file_name_sql=FILE_NAME_SQL) == 2
+    run_worker(path_queue, "worker", fake_generate, "fake-model", poll_interval=0.1)
+
+    with pytest.raises(RuntimeError, match="already has 2 jobs"):
+        create_queue(path_queue, ["a", "b"], n_sentences=3, batch_size=5, file_name_sql=FILE_NAME_SQL)
+    assert queue_status(path_queue) == {"done": 2}
+
+    # With 'reset' the old jobs and their results are deleted
+    assert create_queue(path_queue, ["c"], n_sentences=3, batch_size=5, file_name_sql=FILE_NAME_SQL, reset=True) == 1
+    assert queue_status(path_queue) == {"pending": 1}
+    assert merge_results(path_queue) == []
+
+
+def respond(prompt:str) -> str:
+    """
+    Answer a generation prompt with the number of sentences it asks for.
+    """
+    issue = re.search(r"issue category:\s*'(.*)'", prompt).group(1)
+    n = int(re.search(r"Provide (\d+) sentences", prompt).group(1))
+    return json.dumps([{"dysfunctional": f"{issue} sentence {i}"} for i in range(n)], indent=4)
+
+
+@pytest.mark.parametrize("backend", ["ollama", "openai"])
+def test_workers_call_the_model_endpoint(tmp_path, monkeypatch, backend):
+    pytest.importorskip(backend)
+    if backend == "openai":
+        pytest.importorskip("environ")
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+    from queue_worker import make_generate
+
+    path_queue = tmp_path / "job_queue.db"
+    n_jobs = create_queue(path_queue, ["money", "kids"], n_sentences=7, batch_size=5, file_name_sql=FILE_NAME_SQL)
+
+    with ModelServer(respond) as server:
+        endpoint = server.url + "/v1" if backend == "openai" else server.url
+        generate = make_generate(backend, endpoint, "test-model")
+        assert run_worker(path_queue, "worker", generate, "test-model", poll_interval=0.1) == n_jobs
+
+    assert len(server.requests) == n_jobs
+    assert {request["model"] for request in server.requests} == {"test-model"}
+    assert all(request["stream"] for request in server.requests)
+    assert merge_results(path_queue) == [
+        {"dysfunctional": f"{issue} sentence {i}", "category": issue, "model": "test-model"}
+        for issue in ["money", "kids"] for n in [4, 3] for i in range(n)]
+
+
+def test_merge_writes_the_files_of_each_model(tmp_path):
+    path_queue = tmp_path / "job_queue.db"
+    create_queue(path_queue, ["money"], n_sentences=3, batch_size=5, file_name_sql=FILE_NAME_SQL)
+    run_worker(path_queue, "worker-a", fake_generate, "model-a", poll_interval=0.1)
+    # A job added later and run by a worker with another model
+    con = sqlite3.connect(path_queue)
+    con.execute("INSERT INTO jobs (issue, n_sentences) VALUES ('kids', 2)")
+    con.commit()
+    con.close()
+    run_worker(path_queue, "worker-b", fake_generate, "model-b", poll_interval=0.1)
+
+    # The files are written into the folder used by main.py, with the names it reads
+    (tmp_path / "data_synthetic").mkdir()
+    subprocess.run([sys.executable, str(ROOT / "queue_worker.py"), "--queue", str(path_queue), "merge"],
+                   cwd=tmp_path, check=True, capture_output=True)
+
+    files = sorted(path.name for path in (tmp_path / "data_synthetic").iterdir())
+    assert files == ["synthetic_data_model-a.csv", "synthetic_data_model-a.json",
+                     "synthetic_data_model-b.csv", "synthetic_data_model-b.json"]
+    data = json.loads((tmp_path / "data_synthetic" / "synthetic_data_model-b.json").read_text())
+    assert data == [{"dysfunctional": f"kids {i}", "category": "kids", "model": "model-b"} for i in range(2)]
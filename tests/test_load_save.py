@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from utils.load_save import save_parquet, import_parquet
+from utils.dynamic_prompt import load_examples, find_closest
+
+
+def test_parquet_round_trip_with_embeddings(tmp_path):
+    path_parquet = tmp_path / "data.parquet"
+    rows = [
+        {"dysfunctional": "a", "functional": "fa", "category": "money", "model": "m1"},
+        {"dysfunctional": "b", "functional": "fb", "category": "kids", "model": "m2"}
+    ]
+    save_parquet(rows, path_parquet, [[1.0, 0.0], [0.0, 1.0]])
+
+    data, embeddings = import_parquet(path_parquet)
+
+    assert data == rows
+    assert embeddings.dtype == np.float32
+    assert embeddings.tolist() == [[1.0, 0.0], [0.0, 1.0]]
+
+
+def test_parquet_without_rows(tmp_path):
+    path_parquet = tmp_path / "empty.parquet"
+    save_parquet([], path_parquet, [])
+
+    data, embeddings = import_parquet(path_parquet)
+    assert data == []
+    assert embeddings.shape == (0, 0)
+
+    # No example to select
+    assert find_closest([1.0, 0.0], load_examples(path_parquet)) == ([], [])
+
+
+def test_parquet_embeddings_must_match_the_rows(tmp_path):
+    with pytest.raises(ValueError):
+        save_parquet([{"dysfunctional": "a"}], tmp_path / "data.parquet", [[1.0], [2.0]])
@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from utils.embeddings import create_db
+from utils.pipeline import run_streaming_pipeline
+
+FILE_NAME_SQL = Path(__file__).resolve().parents[1] / "utils" / "create_bd.sql"
+
+
+class FakeClient:
+    """
+    Client with the chat completions and embeddings methods of the OpenAI client:
+    the functional version is the text in upper case, the embedding is [length of the text].
+    """
+
+    def __init__(self, fail_on:str=None):
+        self.fail_on = fail_on
+        self.embedding_calls = []
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def _chat(self, model, messages, temperature):
+        # The text to convert is in the last line of the prompt
+        text = messages[0]["content"].strip().splitlines()[-1].strip()
+        if text == self.fail_on:
+            raise RuntimeError("Conversion failed")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text.upper()))])
+
+    def _embed(self, input, model):
+        with self.lock:
+            self.embedding_calls.append(len(input))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)])
+
+
+def source(name:str, n:int, fail_after:int=None):
+    for i in range(n):
+        if i == fail_after:
+            raise ConnectionError(f"{name} is not running")
+        yield {"dysfunctional": f"{name} sentence {i}", "category": f"issue {i % 2}"}
+
+
+def make_db(tmp_path) -> Path:
+    path_db = tmp_path / "embeddings.db"
+    create_db(FILE_NAME_SQL, path_db)
+    return path_db
+
+
+def read_examples(path_db:Path) -> list:
+    con = sqlite3.connect(path_db)
+    rows = con.execute("SELECT dysfunctional, functional, category, embedding FROM examples").fetchall()
+    con.close()
+    return rows
+
+
+def test_rows_of_every_source_are_converted_embedded_and_inserted(tmp_path):
+    path_db = make_db(tmp_path)
+    client = FakeClient()
+
+    embeddings = {}
+    results = run_streaming_pipeline(
+        {"model-a": source("a", 20), "model-b": source("b", 15)},
+        client, "llm", 0., "emb", path_db, n_convert_workers=3, queue_size=4, emb_batch_size=8,
+        embeddings=embeddings)
+
+    assert {name: len(rows) for name, rows in results.items()} == {"model-a": 20, "model-b": 15}
+    # The embeddings are in the same order as the rows
+    for name in results:
+        assert embeddings[name] == [[float(len(row["dysfunctional"]))] for row in results[name]]
+    assert results["model-a"][0] == {"dysfunctional": "a sentence 0", "functional": "A SENTENCE 0", "category": "issue 0"}
+
+    rows = read_examples(path_db)
+    assert len(rows) == 35
+    assert ("b sentence 3", "B SENTENCE 3", "issue 1", "[12.0]") in rows
+
+    # One embedding request for each batch, not for each row
+    assert sum(client.embedding_calls) == 35
+    assert len(client.embedding_calls) < 35
+    assert max(client.embedding_calls) <= 8
+
+
+def test_a_failed_source_does_not_stop_the_other_sources(tmp_path):
+    path_db = make_db(tmp_path)
+    source_errors = {}
+
+    results = run_streaming_pipeline(
+        {"model-a": source("a", 10), "model-b": source("b", 10, fail_after=4)},
+        FakeClient(), "llm", 0., "emb", path_db, source_errors=source_errors)
+
+    assert {name: len(rows) for name, rows in results.items()} == {"model-a": 10, "model-b": 4}
+    assert list(source_errors) == ["model-b"]
+    assert isinstance(source_errors["model-b"], ConnectionError)
+    assert len(read_examples(path_db)) == 14
+
+
+def test_a_failed_conversion_stops_the_pipeline(tmp_path):
+    path_db = make_db(tmp_path)
+
+    # The producers and converters must not stay blocked on the full queues
+    with pytest.raises(RuntimeError, match="Conversion failed"):
+        run_streaming_pipeline(
+            {"model-a": source("a", 200)},
+            FakeClient(fail_on="a sentence 5"), "llm", 0., "emb", path_db, queue_size=2)
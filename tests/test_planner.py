@@ -0,0 +1,148 @@
+import threading
+
+from utils.planner import split_requests, request_instructions, generate_to_target, stream_to_target
+
+
+class FakeModel:
+    """
+    Generate sentences numbered per issue, returning at most 'max_returned' sentences for each request,
+    and recording the requests.
+    """
+
+    def __init__(self, max_returned:int=100):
+        self.max_returned = max_returned
+        self.requests = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def sentences(self, issue:str, n:int) -> list:
+        with self.lock:
+            start = self.counts.get(issue, 0)
+            n = min(n, self.max_returned)
+            self.counts[issue] = start + n
+        return [{"dysfunctional": f"{issue} sentence {i}", "category": issue} for i in range(start, start + n)]
+
+    def generate(self, issue:str, n:int, instructions:str) -> list:
+        with self.lock:
+            self.requests.append((issue, n, instructions))
+        return self.sentences(issue, n)
+
+
+def test_split_requests():
+    assert split_requests(45, 20) == [15, 15, 15]
+    assert split_requests(50, 25) == [25, 25]
+    assert split_requests(7, 25) == [7]
+    assert split_requests(0, 25) == []
+
+
+def test_requests_are_split_and_have_different_instructions():
+    model = FakeModel()
+
+    responses = generate_to_target(["money", "kids"], 45, model.generate, max_per_request=20)
+
+    assert len(responses) == 90
+    assert sorted(n for issue, n, _ in model.requests if issue == "money") == [15, 15, 15]
+    instructions = [instructions for issue, _, instructions in model.requests if issue == "money"]
+    assert len(set(instructions)) == 3
+    # The responses are grouped by issue
+    assert [row["category"] for row in responses] == ["money"] * 45 + ["kids"] * 45
+
+
+def test_shortfall_is_requested_again():
+    # Each request returns at most 4 sentences
+    model = FakeModel(max_returned=4)
+
+    responses = generate_to_target(["money"], 10, model.generate, max_per_request=5, max_rounds=5)
+
+    assert len(responses) == 10
+    assert [n for _, n, _ in model.requests] == [5, 5, 2]
+    # The top-up lists the sentences already accepted
+    assert "money sentence 7" in model.requests[-1][2]
+
+
+def test_duplicates_and_malformed_sentences_are_not_counted():
+    calls = []
+
+    def generate(issue, n, instructions):
+        calls.append(n)
+        if len(calls) == 1:
+            return [{"dysfunctional": "You never pay!"}, {"dysfunctional": "you never pay"},
+                    {"dysfunctional": None}, "not a sentence", {"dysfunctional": 3}]
+        return [{"dysfunctional": f"new sentence {i}"} for i in range(n)]
+
+    responses = generate_to_target(["money"], 3, generate)
+
+    assert calls == [3, 2]
+    assert [row["dysfunctional"] for row in responses] == ["You never pay!", "new sentence 0", "new sentence 1"]
+
+
+def test_generation_stops_when_a_round_adds_nothing():
+    calls = []
+
+    def generate(issue, n, instructions):
+        calls.append(n)
+        if len(calls) > 1:
+            raise ConnectionError("Server not running")
+        return [{"dysfunctional": "only sentence"}]
+
+    responses = generate_to_target(["money"], 5, generate, max_rounds=5)
+
+    assert calls == [5, 4]
+    assert len(responses) == 1
+
+
+def test_top_up_does_not_wait_for_the_other_issues():
+    top_up_sent = threading.Event()
+    model = FakeModel(max_returned=1)
+
+    def generate(issue, n, instructions):
+        if issue == "slow":
+            # Finishes only once the top-up of "fast" has been sent
+            assert top_up_sent.wait(timeout=10)
+        elif instructions:
+            top_up_sent.set()
+        return model.generate(issue, n, instructions)
+
+    responses = generate_to_target(["slow", "fast"], 2, generate, max_workers=2)
+
+    assert len(responses) == 4
+    assert top_up_sent.is_set()
+
+
+def test_sentences_already_accepted_count_towards_the_target():
+    model = FakeModel()
+    accepted = [{"dysfunctional": "from a batch job", "category": "money"},
+                {"dysfunctional": "From a batch job.", "category": "money"}]
+
+    responses = generate_to_target(["money", "kids"], 3, model.generate, accepted=accepted)
+
+    assert [n for issue, n, _ in model.requests if issue == "money"] == [2]
+    assert [row["dysfunctional"] for row in responses[:3]] == [
+        "from a batch job", "money sentence 0", "money sentence 1"]
+    assert len(responses) == 6
+
+
+def test_request_instructions():
+    assert request_instructions(0, []) == ""
+    assert request_instructions(1, []) != request_instructions(2, [])
+    instructions = request_instructions(3, [{"dysfunctional": f"sentence {i}"} for i in range(40)])
+    # Only the last 'MAX_AVOID' sentences are listed
+    assert "- sentence 10\n" in instructions and instructions.endswith("- sentence 39")
+    assert "- sentence 9\n" not in instructions
+
+
+def test_stream_to_target_yields_unique_sentences_and_tops_up():
+    model = FakeModel(max_returned=3)
+
+    def stream_issue(issue, n, instructions):
+        sentences = model.generate(issue, n, instructions)
+        # The first sentence is repeated in every response
+        yield {"dysfunctional": f"{issue} sentence 0", "category": issue}
+        yield from sentences
+
+    rows = list(stream_to_target(["money", "kids"], 7, stream_issue, max_per_request=4))
+
+    assert [row["dysfunctional"] for row in rows if row["category"] == "kids"] == [
+        f"kids sentence {i}" for i in range(7)]
+    assert len(rows) == 14
+    assert [n for issue, n, _ in model.requests if issue == "money"] == [4, 3, 1]
@@ -0,0 +1,68 @@
+import pytest
+
+from utils.stream_json import JSONArrayParser, InvalidJSONStream, parse_sentences
+
+
+def parse(chunks:list) -> list:
+    parser = JSONArrayParser()
+    objects = [obj for chunk in chunks for obj in parser.feed(chunk)]
+    parser.close()
+    return objects
+
+
+def parse_until_error(chunks:list) -> list:
+    """Return the objects yielded before the parser raised InvalidJSONStream."""
+    parser = JSONArrayParser()
+    objects = []
+    with pytest.raises(InvalidJSONStream):
+        for chunk in chunks:
+            for obj in parser.feed(chunk):
+                objects.append(obj)
+        parser.close()
+    return objects
+
+
+def test_objects_split_across_chunks():
+    text = '[{"dysfunctional": "a"}, {"dysfunctional": "b"}]'
+    expected = [{"dysfunctional": "a"}, {"dysfunctional": "b"}]
+    assert parse([text]) == expected
+    assert parse(list(text)) == expected
+    assert parse([text[:7], text[7:30], text[30:]]) == expected
+
+
+def test_escaped_quotes_and_brackets_inside_strings():
+    text = r'[{"dysfunctional": "he said \"}]{[\" and left \\"}]'
+    assert parse(list(text)) == [{"dysfunctional": 'he said "}]{[" and left \\'}]
+
+
+def test_missing_and_trailing_commas():
+    text = '[{"dysfunctional": "a"}\n{"dysfunctional": "b"},\n]'
+    assert parse([text]) == [{"dysfunctional": "a"}, {"dysfunctional": "b"}]
+
+
+def test_text_after_the_array():
+    assert parse_until_error(['[{"dysfunctional": "a"}] Hope this helps!']) == [{"dysfunctional": "a"}]
+
+
+def test_text_before_the_array():
+    assert parse_until_error(['Sure! [{"dysfunctional": "a"}]']) == []
+
+
+def test_objects_before_an_error_in_the_same_chunk_are_kept():
+    chunks = ['[{"dysfunctional": "a"}', ', {"dysfunctional": "b"} x']
+    assert parse_until_error(chunks) == [{"dysfunctional": "a"}, {"dysfunctional": "b"}]
+
+    # A whole reply in a single chunk, with an invalid last object
+    chunk = '[{"dysfunctional": "a"}, {"dysfunctional": "b"}, {"dysfunctional": 3}]'
+    assert parse_until_error([chunk]) == [{"dysfunctional": "a"}, {"dysfunctional": "b"}]
+
+
+def test_output_ending_before_the_array():
+    assert parse_until_error(['[{"dysfunctional": "a"}, {"dysfu']) == [{"dysfunctional": "a"}]
+
+
+def test_parse_sentences():
+    assert parse_sentences('[{"dysfunctional": "a"}]') == [{"dysfunctional": "a"}]
+    for text in [None, '{"dysfunctional": "a"}', '["a"]', '[{"dysfunctional": null}]', 'not json']:
+        with pytest.raises(ValueError):
+            parse_sentences(text)
@@ -0,0 +1,356 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+from utils.gen_data_openai import create_prompt as create_generation_prompt, generate_data_openai
+from utils.gen_func_language import create_prompt as create_functional_prompt, call_client, pair_text
+from utils.embeddings import get_embedding
+from utils.planner import split_requests, request_instructions, generate_to_target
+from utils.stream_json import parse_sentences
+
+
+def chat_request(custom_id:str, prompt:str, llm_model:str, temperature:float) -> dict:
+    """
+    Create a line of a batch request file for the chat completions endpoint.
+
+    Args:
+        custom_id: Id used to match the result with the request.
+        prompt: Prompt to provide to the model.
+        llm_model: Name of the model.
+        temperature: Parameter of the OpenAI model.
+
+    Returns:
+        A dictionary with the request in the OpenAI batch format.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": llm_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature
+        }
+    }
+
+
+def embedding_request(custom_id:str, text:str, model:str) -> dict:
+    """
+    Create a line of a batch request file for the embeddings endpoint.
+
+    Args:
+        custom_id: Id used to match the result with the request.
+        text: Text to use to generated the vector embedding.
+        model: Name of the model for the embeddings.
+
+    Returns:
+        A dictionary with the request in the OpenAI batch format.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/embeddings",
+        "body": {"model": model, "input": text}
+    }
+
+
+def batch_requests_content(requests:list[dict]) -> str:
+    """
+    Return the content of the JSONL request file, one request for each line.
+    """
+    return "".join(json.dumps(request) + "\n" for request in requests)
+
+
+def write_batch_requests(requests:list[dict], path_requests:Path):
+    """
+    Write the requests into a JSONL file, one request for each line.
+
+    Args:
+        requests: List with the requests in the OpenAI batch format.
+        path_requests: Path for the .jsonl file.
+    """
+    with path_requests.open("w") as f:
+        f.write(batch_requests_content(requests))
+
+
+def submit_batch(client, path_requests:Path, endpoint:str) -> str:
+    """
+    Upload a request file and create a batch job.
+
+    Args:
+        client: A client for the OpenAI API.
+        path_requests: Path to the .jsonl file with the requests.
+        endpoint: Endpoint of the requests, e.g. "/v1/chat/completions".
+
+    Returns:
+        The id of the batch job.
+    """
+    with path_requests.open("rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=endpoint,
+        completion_window="24h")
+
+    return batch.id
+
+
+def wait_for_batch(client, batch_id:str, poll_interval:float=60):
+    """
+    Poll a batch job until it is finished.
+
+    Args:
+        client: A client for the OpenAI API.
+        batch_id: The id of the batch job.
+        poll_interval: Seconds to wait between two checks of the status.
+
+    Returns:
+        The finished batch job, with status "completed", "failed", "expired" or "cancelled".
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        print(" "*4 + f"Batch job {batch_id} is '{batch.status}', checking again in {poll_interval} seconds...")
+        time.sleep(poll_interval)
+
+
+def download_batch_results(client, batch) -> dict:
+    """
+    Download the output file of a finished batch job.
+    An expired or cancelled job can have an output file with the requests completed in time.
+
+    Args:
+        client: A client for the OpenAI API.
+        batch: The finished batch job.
+
+    Returns:
+        A dictionary with the 'custom_id' of the successful requests as keys and the body of the responses as values.
+    """
+    results = {}
+    if batch.output_file_id is None:
+        return results
+
+    content = client.files.content(batch.output_file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response")
+        if result.get("error") is None and response is not None and response["status_code"] == 200:
+            results[result["custom_id"]] = response["body"]
+
+    return results
+
+
+def message_content(results:dict, custom_id:str) -> str:
+    """
+    Return the text of the chat completion of a request of the batch job.
+
+    Args:
+        results: The results returned by 'run_batch'.
+        custom_id: Id of the request.
+
+    Returns:
+        The content of the message, None if the request failed or the content is null
+        (e.g. the completion was stopped by the content filter).
+    """
+    try:
+        content = results[custom_id]["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return content if isinstance(content, str) else None
+
+
+def run_batch(client, requests:list[dict], endpoint:str, folder:Path, stage:str, poll_interval:float=60) -> dict:
+    """
+    Run a stage of the pipeline as a batch job: write the requests into a JSONL file,
+    submit it, wait for the job to complete and download the results.
+
+    The id of the submitted job is stored in a state file in 'folder', so if the process
+    is restarted while the job is running, it resumes polling the same job instead of
+    submitting it again. The state file also stores a hash of the requests: if the requests
+    changed since the job was submitted, the job is not resumed, since its results would be
+    matched to the wrong rows. The state file is removed once the job is finished.
+
+    If the job expired or was cancelled, the results of the requests completed in time are returned,
+    and the callers re-run the other requests one by one.
+
+    The client can point to any server implementing the OpenAI files and batches endpoints
+    (see the 'base_url' argument of the OpenAI client), for example a local stand-in for testing.
+
+    Args:
+        client: A client for the OpenAI API.
+        requests: List with the requests in the OpenAI batch format.
+        endpoint: Endpoint of the requests, e.g. "/v1/chat/completions".
+        folder: Folder for the request file and the state file.
+        stage: Name of the stage, used for the file names.
+        poll_interval: Seconds to wait between two checks of the status.
+
+    Returns:
+        A dictionary with the 'custom_id' of the successful requests as keys and the body of the responses as values.
+
+    Raises:
+        RuntimeError: If the state file belongs to different requests, or if the batch job failed.
+    """
+    path_requests = Path(folder, f"batch_{stage}_requests.jsonl")
+    path_state = Path(folder, f"batch_{stage}_state.json")
+    requests_hash = hashlib.sha256(batch_requests_content(requests).encode()).hexdigest()
+
+    if path_state.exists():
+        with path_state.open("r") as f:
+            state = json.load(f)
+        if state.get("requests_hash") != requests_hash or state.get("n_requests") != len(requests):
+            raise RuntimeError(
+                f"Batch job {state['batch_id']} was submitted for different requests. "
+                f"Remove {path_state} to submit a new job.")
+        batch_id = state["batch_id"]
+        print(f"Resuming batch job {batch_id}")
+    else:
+        print(f"Writing {len(requests)} requests into {path_requests}")
+        write_batch_requests(requests, path_requests)
+        batch_id = submit_batch(client, path_requests, endpoint)
+        with path_state.open("w") as f:
+            json.dump({
+                "batch_id": batch_id,
+                "endpoint": endpoint,
+                "requests_hash": requests_hash,
+                "n_requests": len(requests)
+            }, f)
+        print(f"Batch job {batch_id} submitted")
+
+    batch = wait_for_batch(client, batch_id, poll_interval)
+    # The job is finished (also if it failed), the next run must not resume it
+    path_state.unlink()
+
+    if batch.status == "failed":
+        raise RuntimeError(f"Batch job {batch_id} failed")
+
+    results = download_batch_results(client, batch)
+
+    print(f"Batch job {batch_id} {batch.status}: {len(results)} of {len(requests)} requests succeeded")
+
+    return results
+
+
+def generate_data_openai_batch(issues:list, n_sentences:int, client, llm_model:str, temperature:float,
+                               folder:Path, poll_interval:float=60, max_per_request:int=25, max_workers:int=4) -> list:
+    """
+    Batch version of 'generate_data_openai'.
+    As in 'utils.planner.generate_to_target', the sentences of each issue are split into requests of at most
+    'max_per_request' sentences, each with different instructions. The duplicates are dropped, and the sentences
+    still missing (e.g. missing, null or invalid outputs) are generated with 'generate_to_target', one request at the time.
+
+    Args:
+        issues: A list with the issues to include in the synthetic data query engine.
+        n_sentences: Number of synthetic sentences generate for each issue.
+        client: A client for the OpenAI API.
+        llm_model: Name of the model.
+        temperature: Parameter of the OpenAI model.
+        folder: Folder for the batch files.
+        poll_interval: Seconds to wait between two checks of the status.
+        max_per_request: Max number of sentences in a single request.
+        max_workers: Number of concurrent requests generating the missing sentences.
+
+    Returns:
+        responses: A list with dictionaries containing the genrerated dysfunctional text
+            and the issue category used to generate it, grouped by issue.
+    """
+    requests = []
+    request_issues = {}
+    for i, issue in enumerate(issues):
+        for j, n in enumerate(split_requests(n_sentences, max_per_request)):
+            custom_id = f"issue-{i}-{j}"
+            prompt = create_generation_prompt(issue, n, request_instructions(j, []))
+            requests.append(chat_request(custom_id, prompt, llm_model, temperature))
+            request_issues[custom_id] = issue
+    results = run_batch(client, requests, "/v1/chat/completions", folder, "generation", poll_interval)
+
+    responses = []
+    n_invalid = 0
+    for custom_id, issue in request_issues.items():
+        try:
+            sentences = parse_sentences(message_content(results, custom_id))
+            responses += [{**sentence, "category": issue} for sentence in sentences]
+        except ValueError:
+            n_invalid += 1
+    if n_invalid:
+        print(" "*4 + f"Invalid output for {n_invalid} requests. Re-running model for the missing sentences...")
+
+    return generate_to_target(
+        issues=issues,
+        target=n_sentences,
+        generate=lambda issue, n, instructions: generate_data_openai(
+            [issue], n, client, llm_model, temperature, instructions=instructions),
+        max_per_request=max_per_request,
+        max_workers=max_workers,
+        accepted=responses)
+
+
+def convert_functional_language_batch(data:list[dict], client, llm_model:str, temperature:float,
+                                      folder:Path, poll_interval:float=60) -> list:
+    """
+    Batch version of 'convert_functional_language'.
+    The requests that failed in the batch job, or returned no text, are re-run one by one.
+
+    Args:
+        data: A list with dictionaries containing the dysfunctional text.
+        client: A client for the OpenAI API.
+        llm_model: Name of the model.
+        temperature: Parameter of the OpenAI model.
+        folder: Folder for the batch files.
+        poll_interval: Seconds to wait between two checks of the status.
+
+    Returns:
+        A list with dictionaries containing the dysfunctional text and its functional version (see 'pair_text').
+    """
+    requests = [
+        chat_request(f"row-{i}", create_functional_prompt(text), llm_model, temperature)
+        for i, text in enumerate(data)
+    ]
+    results = run_batch(client, requests, "/v1/chat/completions", folder, "functional", poll_interval)
+
+    responses = []
+    for i, text in enumerate(data):
+        content = message_content(results, f"row-{i}")
+        if content is None:
+            content = call_client(create_functional_prompt(text), client, llm_model, temperature)
+        responses.append(content)
+
+    print(f"Length input: {len(data)}")
+    print(f"Length output: {len(responses)}")
+
+    return pair_text(data, responses)
+
+
+def get_all_embeddings_batch(data:list, model:str, client, folder:Path, poll_interval:float=60) -> list:
+    """
+    Batch version of 'get_all_embeddings'.
+    The requests that failed in the batch job are re-run one by one.
+
+    Args:
+        data: Dataset with all the text to use to generated the vector embedding.
+        model: Name of the model.
+        client: A client for the OpenAI API.
+        folder: Folder for the batch files.
+        poll_interval: Seconds to wait between two checks of the status.
+
+    Returns:
+        A list with lists of vector embeddings for different text in data.
+    """
+    requests = [
+        embedding_request(f"row-{i}", text["dysfunctional"], model)
+        for i, text in enumerate(data)
+    ]
+    results = run_batch(client, requests, "/v1/embeddings", folder, "embeddings", poll_interval)
+
+    embeddings = []
+    for i, text in enumerate(data):
+        if f"row-{i}" in results:
+            embeddings.append(results[f"row-{i}"]["data"][0]["embedding"])
+        else:
+            embeddings.append(get_embedding(text=text["dysfunctional"], model=model, client=client))
+
+    return embeddings
@@ -11,5 +11,19 @@ CREATE TABLE IF NOT EXISTS examples (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     dysfunctional TEXT,
     embedding BLOB,
-    functional TEXT
-)
+    functional TEXT,
+    category TEXT,
+    local_embedding BLOB
+);
+
+-- Index on the issue category, so that a category-filtered query
+-- only scans its own partition
+CREATE INDEX IF NOT EXISTS idx_examples_category ON examples (category);
+
+-- Mean embedding of each issue category, used to route a query
+-- to the closest categories when no category is given
+CREATE TABLE IF NOT EXISTS category_centroids (
+    category TEXT PRIMARY KEY,
+    centroid BLOB,
+    n_examples INTEGER
+);
@@ -0,0 +1,23 @@
+-- Work items: generate 'n_sentences' sentences for an issue category
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    issue TEXT NOT NULL,
+    n_sentences INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'leased', 'done' or 'failed'
+    worker TEXT,                            -- Worker holding the lease
+    lease_expires REAL,                     -- Unix time at which the lease expires
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+
+-- Sentences generated by the workers
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    dysfunctional TEXT,
+    category TEXT,
+    model TEXT,
+    worker TEXT
+);
@@ -2,35 +2,241 @@ import sqlite3
 from pathlib import Path
 import numpy as np
 import json
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.compute as pc
 from sklearn.metrics.pairwise import cosine_similarity
 
 # from embeddings import get_embedding
 from utils.embeddings import get_embedding
+from utils.local_embeddings import get_local_embedding
+from utils.load_save import read_parquet_table, parquet_embeddings
 
 
-def load_examples(path: Path) -> list[dict]:
+def connect_read_only(path: Path):
+    """
+    Open the sql database in read-only mode: building a prompt never changes the database.
+    The columns added after the first version of the database ('category', 'local_embedding')
+    are added when the embeddings are inserted (see 'utils.embeddings.add_category_column').
+    """
+    return sqlite3.connect(f"file:{Path(path).resolve()}?mode=ro", uri=True)
+
+
+def table_columns(conn, table:str) -> list[str]:
+    """
+    Return the names of the columns of a table, an empty list if the table does not exist.
+    """
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def load_examples(path: Path, categories:list[str]=None, embedding_column:str="embedding") -> dict:
+    """
+    Load the examples and their embeddings from the sql database, or from a Parquet file
+    written by 'utils.load_save.save_parquet'.
+    If 'categories' is given, only the examples of these issue categories are loaded,
+    using the index on the 'category' column instead of scanning the whole table.
+
+    The examples are stored in columns: an array with the ids, a single matrix with the
+    embeddings and an array with their norms. The text is not loaded, it is fetched by id only
+    for the selected examples (see 'fetch_example').
+    A Parquet file is read and decoded once (see 'cached_parquet_table'), and the matrix of all the
+    examples is a view on the decoded Arrow buffer; selecting categories copies the selected rows.
+
+    Args:
+        path: Path to the .db or .parquet file with the examples and their embeddings.
+        categories: Issue categories to load, None to load all the examples.
+        embedding_column: Column with the embeddings to load, "embedding" for the remote model
+            or "local_embedding" for the local one (see 'utils.local_embeddings').
+
+    Returns:
+        examples: A dictionary with the examples, it has this structure:
+            {'path': Path to the .db file,
+            'ids': array([1, 2, ...]),
+            'embeddings': array([[ 0.03117449,  0.03328631, ..., -0.01784991],
+                                 [ 0.05065854,  0.01244088, ...,  0.00821188],
+                                 ...], dtype=float32),
+            'norms': array([1.0000001, 0.99999994, ...], dtype=float32)}
+    """
+    if Path(path).suffix == ".parquet":
+        return load_examples_parquet(path, categories, embedding_column)
+
+    if embedding_column not in ("embedding", "local_embedding"):
+        raise ValueError(f"Unknown embedding column: {embedding_column}")
+
     # Fetch embedding from sql database
-    conn = sqlite3.connect(path)
+    conn = connect_read_only(path)
+    columns = table_columns(conn, "examples")
+    if embedding_column not in columns:
+        conn.close()
+        raise ValueError(f"The database has no '{embedding_column}' column, insert the embeddings first")
     cursor = conn.cursor()
-    cursor.execute('SELECT id, dysfunctional, embedding, functional FROM examples')
-    rows = cursor.fetchall()
+    query = f'SELECT id, {embedding_column} FROM examples WHERE {embedding_column} IS NOT NULL'
+    if categories is None:
+        cursor.execute(query)
+    elif "category" not in columns:
+        # Database created before the issue category was stored: no example has a category
+        cursor.execute(f'{query} AND 0')
+    else:
+        placeholders = ", ".join("?" * len(categories))
+        cursor.execute(f'{query} AND category IN ({placeholders})', list(categories))
+
+    # Move ids and embeddings into arrays
+    ids = []
+    embeddings = []
+    for row in cursor:
+        ids.append(row[0])
+        embeddings.append(np.array(json.loads(row[1]), dtype=np.float32))
+    conn.close()
+
+    embeddings = np.vstack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+    return {
+        'path': path,
+        'ids': np.array(ids, dtype=np.int64),
+        'embeddings': embeddings,
+        'norms': np.linalg.norm(embeddings, axis=1)
+    }
+
+
+def load_examples_parquet(path: Path, categories:list[str]=None, embedding_column:str="embedding") -> dict:
+    """
+    Load the examples and their embeddings from a Parquet file (see 'load_examples').
+    The id of an example is its row number in the file.
+
+    Args:
+        path: Path to the .parquet file with the examples and their embeddings.
+        categories: Issue categories to load, None to load all the examples.
+        embedding_column: Column with the embeddings to load, only "embedding" is stored in Parquet files.
+
+    Returns:
+        examples: A dictionary with the examples (see 'load_examples').
+    """
+    if embedding_column != "embedding":
+        raise ValueError(f"Unknown embedding column for a Parquet file: {embedding_column}")
+
+    table = cached_parquet_table(str(path))
+    embeddings = parquet_embeddings(table)
+    ids = np.arange(len(embeddings), dtype=np.int64)
+
+    if categories is not None:
+        mask = pc.is_in(table.column("category"), value_set=pa.array(list(categories), type=pa.string()))
+        mask = mask.fill_null(False).to_numpy(zero_copy_only=False)
+        ids = ids[mask]
+        embeddings = embeddings[mask]
+
+    return {
+        'path': path,
+        'ids': ids,
+        'embeddings': embeddings,
+        'norms': np.linalg.norm(embeddings, axis=1)
+    }
+
+
+@lru_cache(maxsize=4)
+def cached_parquet_table(path: str) -> pa.Table:
+    """
+    Read and decode a Parquet file once and reuse the table for the following queries.
+    """
+    return read_parquet_table(path)
+
+
+@lru_cache(maxsize=1024)
+def fetch_example(path: str, example_id:int) -> dict:
+    """
+    Fetch the text of an example from the sql database or the Parquet file.
+    The most recently used examples are cached.
+
+    Args:
+        path: Path to the .db or .parquet file with the examples.
+        example_id: Id of the example.
+
+    Returns:
+        A dictionary with the dysfunctional text and its functional version.
+    """
+    if Path(path).suffix == ".parquet":
+        row = cached_parquet_table(path).slice(example_id, 1).select(["dysfunctional", "functional"])
+        return row.to_pylist()[0]
+
+    conn = connect_read_only(path)
+    row = conn.execute('SELECT dysfunctional, functional FROM examples WHERE id = ?', (example_id,)).fetchone()
     conn.close()
 
-    # Move embedding and text into a list
-    examples = []
-    for row in rows:
-        examples.append({
-            'id': row[0],
-            'dysfunctional': row[1],
-            'embedding': np.array(json.loads(row[2])),
-            'functional': row[3]
-        })
+    return {"dysfunctional": row[0], "functional": row[1]}
+
+
+def load_category_centroids(path: Path) -> dict:
+    """
+    Load the centroids of the issue categories from the sql database
+    (see 'utils.embeddings.update_category_centroids').
+    A Parquet file has no centroids table, so they are computed from its 'category' and 'embedding' columns.
+
+    Args:
+        path: Path to the .db or .parquet file with the examples and their embeddings.
+
+    Returns:
+        A dictionary with the issue categories as keys and their centroids as values,
+        empty if the centroids were never computed.
+    """
+    if Path(path).suffix == ".parquet":
+        return parquet_category_centroids(path)
+
+    conn = connect_read_only(path)
+    if not table_columns(conn, "category_centroids"):
+        conn.close()
+        return {}
+    rows = conn.execute('SELECT category, centroid FROM category_centroids').fetchall()
+    conn.close()
+
+    return {category: np.array(json.loads(centroid)) for category, centroid in rows}
+
+
+@lru_cache(maxsize=4)
+def parquet_category_centroids(path: Path) -> dict:
+    """
+    Compute the centroid (normalized mean embedding) of each issue category of a Parquet file,
+    as 'utils.embeddings.update_category_centroids' does for the sql database.
+    Examples without a category are ignored.
+
+    Args:
+        path: Path to the .parquet file with the examples and their embeddings.
+
+    Returns:
+        A dictionary with the issue categories as keys and their centroids as values.
+    """
+    table = cached_parquet_table(str(path))
+    embeddings = parquet_embeddings(table)
+    categories = np.array(table.column("category").to_pylist(), dtype=object)
+
+    centroids = {}
+    for category in sorted(set(categories) - {None}):
+        emb_sum = embeddings[categories == category].sum(axis=0, dtype=np.float64)
+        centroids[category] = emb_sum / np.linalg.norm(emb_sum)
 
-    return examples
+    return centroids
 
 
+def route_categories(input_embedding:list, centroids:dict, n_categories:int=1) -> list[str]:
+    """
+    Return the n_categories issue categories whose centroid is closest
+    (cosine similarity) to the input_embedding.
+
+    Args:
+        input_embedding: Embedding of the user's text.
+        centroids: Dictionary with the issue categories and their centroids.
+        n_categories: Number of categories to select.
 
-def find_closest(input_embedding:list, examples:list[dict], top_n:int=5) -> list[dict]:
+    Returns:
+        A list with the selected issue categories, from the closest one.
+    """
+    categories = list(centroids.keys())
+    similarities = cosine_similarity([input_embedding], [centroids[c] for c in categories])[0]
+    closest_indices = similarities.argsort()[-n_categories:][::-1]
+
+    return [categories[i] for i in closest_indices]
+
+
+
+def find_closest(input_embedding:list, examples:dict, top_n:int=5) -> list[dict]:
     """
     Return top_n pairs of dysfunctional text and its functional version,
     based on the cosine similarity with the input_embedding, which is the
@@ -38,19 +244,14 @@ def find_closest(input_embedding:list, examples:list[dict], top_n:int=5) -> list
 
      Args:
         input_embedding: Embedding of the user's text.
-        examples: List with dictionaries containing dysfunctional text, the dysfunctinal text embedding, and the functional version.
+        examples: Dictionary with the ids, the embeddings and their norms (see 'load_examples').
             It has this structure:
-                [
-                    {'id': 1,
-                    'dysfunctional': "A dysfucntional example",
-                    'embedding': array([ 0.03117449,  0.03328631, -0.00667486, ..., -0.01784991,]),
-                    'functional': "The functional version of the text"},
-                    {'id': 2,
-                    'dysfunctional': "A dysfucntional example",
-                    'embedding': array([ 0.05065854,  0.01244088, -0.04797346, ...,  0.00821188,]),
-                    'functional': "The functional version of the text"},
-                    ...
-                ]
+                {'path': Path to the .db file,
+                'ids': array([1, 2, ...]),
+                'embeddings': array([[ 0.03117449,  0.03328631, ..., -0.01784991],
+                                     [ 0.05065854,  0.01244088, ...,  0.00821188],
+                                     ...], dtype=float32),
+                'norms': array([1.0000001, 0.99999994, ...], dtype=float32)}
         top_n: number examples to select.
 
     Returns:
@@ -68,33 +269,59 @@ def find_closest(input_embedding:list, examples:list[dict], top_n:int=5) -> list
             dysfunctional examples .
             It has this structure:
                 [
-                    np.float64(0.6548426546546),
-                    np.float64(0.5864792914286),
+                    np.float32(0.6548426546546),
+                    np.float32(0.5864792914286),
                     ...
                 ]
     """
 
-    example_embeddings = [example['embedding'] for example in examples]
-    similarities = cosine_similarity([input_embedding], example_embeddings)[0]
-    similar_indices = similarities.argsort()[-top_n:][::-1]
+    # No example in the selected categories: the embedding matrix has no columns to multiply
+    if len(examples['ids']) == 0:
+        return [], []
+
+    # Cosine similarity with all the examples in a single matrix product
+    input_embedding = np.asarray(input_embedding, dtype=np.float32)
+    similarities = examples['embeddings'] @ (input_embedding / np.linalg.norm(input_embedding))
+    similarities /= np.maximum(examples['norms'], 1e-12)
 
-    selected_examples = [{"dysfunctional":examples[i]["dysfunctional"], "functional":examples[i]["functional"]} for i in similar_indices]
+    # Select the top_n examples without sorting all the similarities
+    top_n = min(top_n, len(similarities))
+    top_indices = np.argpartition(similarities, -top_n)[-top_n:] if top_n > 0 else np.array([], dtype=np.int64)
+    similar_indices = top_indices[np.argsort(similarities[top_indices])[::-1]]
+
+    # Fetch the text only for the selected examples
+    selected_examples = [dict(fetch_example(str(examples['path']), int(examples['ids'][i]))) for i in similar_indices]
 
     selected_similarities = [similarities[i] for i in similar_indices]
 
     return selected_examples, selected_similarities
 
 
-def select_examples(input_text:str, path_emb:Path , emb_model:str, client, num_examples:int=5) -> tuple[list, list]:
+def select_examples(input_text:str, path_emb:Path , emb_model:str, client, num_examples:int=5,
+                    categories:list[str]=None, n_route_categories:int=None,
+                    embedder:str="remote", local_embedder:dict=None) -> tuple[list, list]:
     """
     Select the most relevant few-shot examples based on cosine similarity.
 
+    The search can be restricted to one or more issue categories: in that case only
+    their partitions are loaded from the database.
+    If no category is given and 'n_route_categories' is set, the query is routed to the
+    'n_route_categories' categories with the closest centroid.
+
+    With 'embedder="local"' the user's text is embedded on CPU with the local projection,
+    without calling the API, and compared with the local embeddings of the examples.
+    The local projection approximates the remote embeddings, so the same centroids are used for routing.
+
     Args:
         data: Dataset with all the text to use to generated the vector embedding.
-        path_emb: Path to the .db file with the examples and their embeddings.
+        path_emb: Path to the .db or .parquet file with the examples and their embeddings.
         emb_model: Name of the model for the embeddings.
         client: A client for the OpenAI API.
         num_examples: number examples to select.
+        categories: Issue category (or list of categories) in which to search, None to search all the examples.
+        n_route_categories: Number of categories to search when routing with the centroids.
+        embedder: "remote" to embed the user text with 'emb_model', "local" to use 'local_embedder'.
+        local_embedder: The projection returned by 'utils.local_embeddings.load_local_embedder'.
 
 
     Returns:
@@ -103,13 +330,27 @@ def select_examples(input_text:str, path_emb:Path , emb_model:str, client, num_e
     """
 
     # Embed the user text
-    input_embedding = get_embedding(
-        text=input_text,
-        model=emb_model,
-        client=client)
+    if embedder == "local":
+        input_embedding = get_local_embedding(input_text, local_embedder)
+        embedding_column = "local_embedding"
+    else:
+        input_embedding = get_embedding(
+            text=input_text,
+            model=emb_model,
+            client=client)
+        embedding_column = "embedding"
     
+    if isinstance(categories, str):
+        categories = [categories]
+
+    # Route the query to the closest categories
+    if categories is None and n_route_categories is not None:
+        centroids = load_category_centroids(path_emb)
+        if centroids:
+            categories = route_categories(input_embedding, centroids, n_route_categories)
+
     # Load the examples
-    examples = load_examples(path_emb)
+    examples = load_examples(path_emb, categories, embedding_column)
 
     # Find the semantically closest example to the input text
     selected_examples, _ = find_closest(input_embedding, examples, num_examples)
@@ -117,16 +358,22 @@ def select_examples(input_text:str, path_emb:Path , emb_model:str, client, num_e
     return selected_examples
 
 
-def create_dynamic_prompt(user_text: str, path_emb:Path , emb_model:str, client, num_examples:int=5) -> str:
+def create_dynamic_prompt(user_text: str, path_emb:Path , emb_model:str, client, num_examples:int=5,
+                          categories:list[str]=None, n_route_categories:int=None,
+                          embedder:str="remote", local_embedder:dict=None) -> str:
     """
     Return a prompt based on the user's text and the selected  examples to enter in the prompt as few-shots.
 
      Args:
         user_text: The user's text.
-        path_emb: Path to the .db file with the examples and their embeddings.
+        path_emb: Path to the .db or .parquet file with the examples and their embeddings.
         emb_model: Name of the model for the embeddings.
         client: A client for the OpenAI API.
         num_examples: number examples to select.
+        categories: Issue category (or list of categories) in which to search, None to search all the examples.
+        n_route_categories: Number of categories to search when routing with the centroids.
+        embedder: "remote" to embed the user text with 'emb_model', "local" to use 'local_embedder'.
+        local_embedder: The projection returned by 'utils.local_embeddings.load_local_embedder'.
         
 
     Returns:
@@ -150,7 +397,11 @@ def create_dynamic_prompt(user_text: str, path_emb:Path , emb_model:str, client,
         path_emb=path_emb,
         emb_model=emb_model,
         client=client,
-        num_examples=num_examples)
+        num_examples=num_examples,
+        categories=categories,
+        n_route_categories=n_route_categories,
+        embedder=embedder,
+        local_embedder=local_embedder)
 
     prompt_1 = """
     Below is an instruction that describes a task.
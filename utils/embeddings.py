@@ -2,6 +2,7 @@ import json
 import sys
 from pathlib import Path
 import sqlite3
+import numpy as np
 
 
 def get_embedding(text: str, model:str, client) -> list:
@@ -20,6 +21,22 @@ def get_embedding(text: str, model:str, client) -> list:
     return response.data[0].embedding
 
 
+def get_embeddings(texts:list[str], model:str, client) -> list:
+    """
+    Generate the embeddings of several texts with a single request to OpenAI's API.
+
+    Args:
+        texts: List with the text to use to generated the vector embeddings.
+        model: Name of the model for the embeddings.
+        client: A client for the OpenAI API.
+
+    Returns:
+        A list with the vector embedding of each text, in the same order as 'texts'.
+    """
+    response = client.embeddings.create(input=texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
 def get_all_embeddings(data:list, model:str, client):
     """
     Generate embeddings for all the text in 'data'.
@@ -70,21 +87,44 @@ def create_db(file_name_sql:str, file_name_bd:str):
         db.close()
 
 
+def add_category_column(con):
+    """
+    Add the 'category' column (and its index) to an 'examples' table
+    created before the issue category was stored.
+    It runs when the embeddings are inserted, so that the query path can open the database read-only.
+
+    Args:
+        con: An open connection to the .db file.
+    """
+    columns = [row[1] for row in con.execute("PRAGMA table_info(examples)")]
+    if "category" not in columns:
+        con.execute("ALTER TABLE examples ADD COLUMN category TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_examples_category ON examples (category)")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS category_centroids "
+        "(category TEXT PRIMARY KEY, centroid BLOB, n_examples INTEGER)"
+    )
+
+
 def insert_embeddings(data:list, embeddings:list, path_db:str):
     """
     This function insert the embeddings in a .db file.
     'data' is a list of dictionaries, for example:
         [
             {'dysfunctional': "Text to embed",
-            'functional': "Functional version of the Text to embed, we do not embed this text"},
+            'functional': "Functional version of the Text to embed, we do not embed this text",
+            'category': "Issue category used to generate the text"},
             {'dysfunctional': "Next text to embed",
-            'functional': "Functional version, we do not embed this text"}
+            'functional': "Functional version, we do not embed this text",
+            'category': "Issue category used to generate the text"}
         ]
+    The 'category' key is optional, examples without it are stored with a NULL category.
+    A Parquet dataset can be inserted with: insert_embeddings(*import_parquet(path_parquet), path_db)
 
     Args:
-        data: List with the dysfunctional text (used to generated the vector embedding) 
-              and the functional version.
-        embeddings: List with the embedding for the dysfunctional text.
+        data: List with the dysfunctional text (used to generated the vector embedding),
+              the functional version and the issue category.
+        embeddings: List (or matrix) with the embedding for the dysfunctional text.
         path_db: Path to the .db file in which insert the text and embeddings.
 
     Returns:
@@ -92,9 +132,67 @@ def insert_embeddings(data:list, embeddings:list, path_db:str):
     """
     con = sqlite3.connect(path_db)
     with con:
-        for ex, emb in zip(data, embeddings):
+        add_category_column(con)
+        insert_examples(con, data, embeddings)
+    con.close()
+
+
+def insert_examples(con, data:list, embeddings:list):
+    """
+    Insert the examples and their embeddings with an open connection (see 'insert_embeddings').
+    The 'category' column must exist (see 'add_category_column'), and the caller commits.
+
+    Args:
+        con: An open connection to the .db file.
+        data: List with the dysfunctional text, the functional version and the issue category.
+        embeddings: List (or matrix) with the embedding for the dysfunctional text.
+    """
+    con.executemany(
+        "INSERT INTO examples (dysfunctional, embedding, functional, category) VALUES (?, ?, ?, ?)",
+        [(ex["dysfunctional"], json.dumps(np.asarray(emb).tolist()), ex["functional"], ex.get("category"))
+         for ex, emb in zip(data, embeddings)]
+    )
+
+
+def update_category_centroids(path_db:str):
+    """
+    Compute the centroid (normalized mean embedding) of each issue category
+    and store it in the 'category_centroids' table.
+    The centroids are used to route a query to the closest categories,
+    so that only their partitions have to be searched.
+    Examples without a category are ignored.
+
+    Args:
+        path_db: Path to the .db file with the examples and their embeddings.
+
+    Returns:
+        A dictionary with the number of examples in each category.
+    """
+    con = sqlite3.connect(path_db)
+    with con:
+        add_category_column(con)
+        rows = con.execute(
+            "SELECT category, embedding FROM examples WHERE category IS NOT NULL ORDER BY category"
+        ).fetchall()
+
+        # Sum the embeddings of each category
+        sums = {}
+        counts = {}
+        for category, emb in rows:
+            emb = np.array(json.loads(emb))
+            if category in sums:
+                sums[category] += emb
+            else:
+                sums[category] = emb
+            counts[category] = counts.get(category, 0) + 1
+
+        con.execute("DELETE FROM category_centroids")
+        for category, emb_sum in sums.items():
+            centroid = emb_sum / np.linalg.norm(emb_sum)
             con.execute(
-                "INSERT INTO examples (dysfunctional, embedding, functional) VALUES (?, ?, ?)",
-                (ex["dysfunctional"], json.dumps(emb), ex["functional"])
+                "INSERT INTO category_centroids (category, centroid, n_examples) VALUES (?, ?, ?)",
+                (category, json.dumps(centroid.tolist()), counts[category])
             )
     con.close()
+
+    return counts
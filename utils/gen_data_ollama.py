@@ -1,10 +1,17 @@
-import json
 import csv
 from pathlib import Path
 import ollama
 
+from utils.stream_json import JSONArrayParser, InvalidJSONStream, parse_sentences
 
-def call_model(prompt:str, system_message:str, model_name:str) -> list:
+
+SYSTEM_MESSAGE = """
+You are an AI assistant that outputs only JSON data.
+Do not include any text before or after the JSON response.
+"""
+
+
+def call_model(prompt:str, system_message:str, model_name:str, client=None) -> list:
     """
     Take a prompt and a model name and use the ollama framework to generate a response.
 
@@ -12,44 +19,195 @@ def call_model(prompt:str, system_message:str, model_name:str) -> list:
         prompt: Prompt to provide to the model.
         system_message: System message to provide to the model.
         model_name: Name of the model.
+        client: An 'ollama.Client' pointing to a specific Ollama server, None to use the default one.
 
     Returns:
         responses: A list with dictionaries containing the genrerated dysfunctional text and a tranformed functional version.
     """
 
-    response = ollama.generate(
+    response = (client or ollama).generate(
             model=model_name,
             prompt=prompt,
             system=system_message)
-        
+
     return response["response"]
 
 
-def generate_data_ollama(issues:list, n_sentences:int, llm_model:str, max_iteration:int=5) -> list:
+def call_model_stream(prompt:str, system_message:str, model_name:str, client=None):
     """
-    This function uses the Ollama framework to generate dysfunctional text using as categories the 
+    Streaming version of 'call_model': yield the text of the response chunk by chunk.
+
+    Args:
+        prompt: Prompt to provide to the model.
+        system_message: System message to provide to the model.
+        model_name: Name of the model.
+        client: An 'ollama.Client' pointing to a specific Ollama server, None to use the default one.
+
+    Yields:
+        A string with the next piece of the response.
+    """
+
+    stream = (client or ollama).generate(
+            model=model_name,
+            prompt=prompt,
+            system=system_message,
+            stream=True)
+
+    for chunk in stream:
+        yield chunk["response"]
+
+
+def create_prompt(issue:str, n_sentences:int, instructions:str="") -> str:
+    """
+    Create the prompt to generate 'n_sentences' dysfunctional sentences for an issue category.
+
+    Args:
+        issue: The issue category of the sentences.
+        n_sentences: Number of synthetic sentences to generate.
+        instructions: Additional instructions for this request (see 'utils.planner.request_instructions').
+
+    Returns:
+        A string with the prompt.
+    """
+
+    prompt_1 = f"""
+    Generate examples of dysfunctional and toxic language that might be encountered between couples or
+    ex-couples who have to continuously interact.
+
+    Each entry should generate a sentence reflecting dysfunctional communication, showcasing various forms
+    of toxicity such as insults, harassment, threats, manipulation, and derogatory remarks.
+
+    Ensure the sentences are realistic and diverse in terms of content and context.
+    The sentences should refer to this issue category:
+    '{issue}'
+
+    Provide {n_sentences} sentences.
+    {instructions}
+    """
+
+    # The prompt is divided into 2 sub-prompts because
+    # the example of the output format uses Curly brackets {},
+    # and this cannot be done in a f-string.
+    prompt_2 = """
+    Always respond only with valid JSON format and nothing else.
+    Do not include any text before or after the JSON.
+
+    You must provide the output exactly in the following format:
+
+    [
+        {"dysfunctional": "write here the dysfunctional text"}
+        {"dysfunctional": "write here the dysfunctional text"},
+    ]
+    """
+
+    return prompt_1 + prompt_2
+
+
+def stream_issue_ollama(issue:str, n_sentences:int, llm_model:str, max_iteration:int=5, client=None,
+                        instructions:str=""):
+    """
+    Stream the response of the Ollama model for one issue category and yield each sentence
+    as soon as it is received.
+
+    The output is parsed incrementally: if it becomes invalid JSON, the generation is aborted right away
+    and the model is re-run, asking only for the sentences still missing.
+    The sentences already received are kept.
+
+    Args:
+        issue: The issue category of the sentences.
+        n_sentences: Number of synthetic sentences to generate.
+        llm_model: Name of the model.
+        max_iteration: Max number of iteration to try before aborting the function.
+        client: An 'ollama.Client' pointing to a specific Ollama server, None to use the default one.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
+
+    Yields:
+        A dictionary with a generated dysfunctional text and its issue category.
+    """
+
+    n_received = 0
+    num_tries = 0
+
+    while n_received < n_sentences:
+        stream = call_model_stream(
+            create_prompt(issue, n_sentences - n_received, instructions), SYSTEM_MESSAGE, llm_model, client)
+        parser = JSONArrayParser()
+
+        try:
+            for chunk in stream:
+                for sentence in parser.feed(chunk):
+                    n_received += 1
+                    yield {**sentence, "category": issue}
+            parser.close()
+            break
+        except InvalidJSONStream:
+            # Stop the generation, no need to wait for the rest of an invalid output
+            stream.close()
+            num_tries += 1
+            if num_tries >= max_iteration:
+                print(" "*4 + f"Invalid JSON format after {max_iteration} retries. Aborting...")
+                break
+            print(" "*4 + f"Invalid JSON format. Re-running model for {n_sentences - n_received} sentences...")
+
+
+def stream_data_ollama(issues:list, n_sentences:int, llm_model:str, max_iteration:int=5, client=None,
+                       instructions:str=""):
+    """
+    Streaming version of 'generate_data_ollama': yield each generated sentence as soon as it is received,
+    so that the next stages can start before the whole dataset is generated.
+
+    Args:
+        issues: A list with the issues to include in the synthetic data query engine.
+        n_sentences: Number of synthetic sentences generate for each issue.
+        llm_model: Name of the model.
+        max_iteration: Max number of iteration to try before aborting the function.
+        client: An 'ollama.Client' pointing to a specific Ollama server, None to use the default one.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
+
+    Yields:
+        A dictionary with a generated dysfunctional text and its issue category.
+    """
+
+    for N_issue, issue in enumerate(issues, start=1):
+        print(f"Generating output {N_issue} of {len(issues)}")
+        yield from stream_issue_ollama(issue, n_sentences, llm_model, max_iteration, client, instructions)
+
+
+def generate_data_ollama(issues:list, n_sentences:int, llm_model:str, max_iteration:int=5, stream:bool=False,
+                         client=None, instructions:str="") -> list:
+    """
+    This function uses the Ollama framework to generate dysfunctional text using as categories the
     issues listed in the "issues" list.
     The model output from the Ollama model was unstable and frequently did not conform to a JSON file format.
-    
+
     To resolve this, I implemented the following:
     - Introduced a 'system message'.
     - Reiterated the desired format in the 'prompt'.
-    
+
     But also with these adjustments, the model now does not generate the desired output format.
     So I added a for loop with 'max_iteration' iterations, that is a way to check if the output
     is correct and if not it re-run the model.
+    With 'stream=True' the output is checked while it is generated (see 'stream_issue_ollama'),
+    so an invalid output is re-run without waiting for the full response.
 
     Args:
         issues: A list with the issues to include in the synthetic data query engine.
         n_sentences: Number of synthetic sentences generate for each issue.
         llm_model: Name of the model.
         max_iteration: Max number of iteration to try before aborting the function.
+        stream: If True, stream the responses and parse them incrementally.
+        client: An 'ollama.Client' pointing to a specific Ollama server, None to use the default one.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
 
     Returns:
-        responses: A list with a dictionaries containing the generated dysfunctional text.
+        responses: A list with a dictionaries containing the generated dysfunctional text
+            and the issue category used to generate it.
 
     """
 
+    if stream:
+        return list(stream_data_ollama(issues, n_sentences, llm_model, max_iteration, client, instructions))
+
     # List to store the responses
     responses = []
 
@@ -62,52 +220,20 @@ def generate_data_ollama(issues:list, n_sentences:int, llm_model:str, max_iterat
         print(f"Generating output {N_issue} of {len(issues)}")
         N_issue += 1
 
-        system_message = """
-        You are an AI assistant that outputs only JSON data.
-        Do not include any text before or after the JSON response.
-        """
-
-        prompt_1 = f""" 
-        Generate examples of dysfunctional and toxic language that might be encountered between couples or 
-        ex-couples who have to continuously interact.
-    
-        Each entry should generate a sentence reflecting dysfunctional communication, showcasing various forms
-        of toxicity such as insults, harassment, threats, manipulation, and derogatory remarks.
-    
-        Ensure the sentences are realistic and diverse in terms of content and context.
-        The sentences should refer to this issue category:
-        '{issue}'
-    
-        Provide {n_sentences} sentences.
-        """
-    
-        # The prompt is divided into 2 sub-prompts because
-        # the example of the output format uses Curly brackets {},
-        # and this cannot be done in a f-string.
-        prompt_2 = """
-        Always respond only with valid JSON format and nothing else.
-        Do not include any text before or after the JSON.
-
-        You must provide the output exactly in the following format:
-        
-        [
-            {"dysfunctional": "write here the dysfunctional text"}
-            {"dysfunctional": "write here the dysfunctional text"},
-        ]
-        """
-    
-        prompt = prompt_1 + prompt_2
+        prompt = create_prompt(issue, n_sentences, instructions)
 
         num_tries = 0
 
         while True:
-            r = call_model(prompt, system_message, llm_model)
-        
+            r = call_model(prompt, SYSTEM_MESSAGE, llm_model, client)
+
             # Check if output is valid JSON
             try:
-                responses += json.loads(r)
+                sentences = parse_sentences(r)
+                # Keep track of the issue category each sentence was generated for
+                responses += [{**sentence, "category": issue} for sentence in sentences]
                 break
-            except json.JSONDecodeError:
+            except ValueError:
                 num_tries += 1
                 if num_tries >= max_iteration:
                     print(" "*4 + f"Invalid JSON format after {max_iteration} retries. Aborting...")
@@ -1,16 +1,142 @@
-import json
 import csv
 from pathlib import Path
 
+from utils.stream_json import JSONArrayParser, InvalidJSONStream, parse_sentences
 
-def generate_data_openai(issues: list, n_sentences: int, client, llm_model:str, temperature:float, max_iteration:int=5) -> list:
+
+def create_prompt(issue:str, n_sentences:int, instructions:str="") -> str:
+    """
+    Create the prompt to generate 'n_sentences' dysfunctional sentences for an issue category.
+
+    Args:
+        issue: The issue category of the sentences.
+        n_sentences: Number of synthetic sentences to generate.
+        instructions: Additional instructions for this request (see 'utils.planner.request_instructions').
+
+    Returns:
+        A string with the prompt.
+    """
+
+    prompt_1 = f"""
+    Generate examples of dysfunctional and toxic language that might be encountered between couples or
+    ex-couples who have to continuously interact.
+
+    Each entry should generate a sentence reflecting dysfunctional communication, showcasing various forms
+    of toxicity such as insults, harassment, threats, manipulation, and derogatory remarks.
+
+    Ensure the sentences are realistic and diverse in terms of content and context.
+    The sentences should refer to this issue category:
+    '{issue}'
+
+    Provide {n_sentences} sentences.
+    {instructions}
+    """
+
+    # The prompt is divided into 2 sub-prompts because
+    # the example of the output format uses Curly brackets {},
+    # and this cannot be done in a f-string.
+    prompt_2 = """
+    Write the output using this format:
+    [
+        {"dysfunctional": "write here the dysfunctional text"},
+        {"dysfunctional": "write here the dysfunctional text"},
+    ]
+    """
+
+    return prompt_1 + prompt_2
+
+
+def stream_issue_openai(issue:str, n_sentences:int, client, llm_model:str, temperature:float, max_iteration:int=5,
+                        instructions:str=""):
+    """
+    Stream the completion of the OpenAI API for one issue category and yield each sentence
+    as soon as it is received.
+
+    The output is parsed incrementally: if it becomes invalid JSON, the stream is aborted right away
+    and the model is re-run, asking only for the sentences still missing.
+    The sentences already received are kept.
+
+    Args:
+        issue: The issue category of the sentences.
+        n_sentences: Number of synthetic sentences to generate.
+        client: A client for the OpenAI API.
+        llm_model: Name of the model.
+        temperature: Parameter of the OpenAI model.
+        max_iteration: Max number of iteration to try before aborting the function.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
+
+    Yields:
+        A dictionary with a generated dysfunctional text and its issue category.
     """
-    This function calls the OpenAI API to generate dysfunctional text using as categories the 
+
+    n_received = 0
+    num_tries = 0
+
+    while n_received < n_sentences:
+        stream = client.chat.completions.create(
+            model=llm_model,
+            messages=[
+                {"role": "user", "content": create_prompt(issue, n_sentences - n_received, instructions)}
+            ],
+            temperature=temperature,
+            stream=True,
+        )
+        parser = JSONArrayParser()
+
+        try:
+            for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                for sentence in parser.feed(chunk.choices[0].delta.content):
+                    n_received += 1
+                    yield {**sentence, "category": issue}
+            parser.close()
+            break
+        except InvalidJSONStream:
+            # Stop the generation, no need to wait for the rest of an invalid output
+            stream.response.close()
+            num_tries += 1
+            if num_tries >= max_iteration:
+                print(" "*4 + f"Invalid JSON format after {max_iteration} retries. Aborting...")
+                break
+            print(" "*4 + f"Invalid JSON format. Re-running model for {n_sentences - n_received} sentences...")
+
+
+def stream_data_openai(issues: list, n_sentences: int, client, llm_model:str, temperature:float, max_iteration:int=5,
+                       instructions:str=""):
+    """
+    Streaming version of 'generate_data_openai': yield each generated sentence as soon as it is received,
+    so that the next stages can start before the whole dataset is generated.
+
+    Args:
+        issues: A list with the issues to include in the synthetic data query engine.
+        n_sentences: Number of synthetic sentences generate for each issue.
+        client: A client for the OpenAI API.
+        llm_model: Name of the model.
+        temperature: Parameter of the OpenAI model.
+        max_iteration: Max number of iteration to try before aborting the function.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
+
+    Yields:
+        A dictionary with a generated dysfunctional text and its issue category.
+    """
+
+    for N_issue, issue in enumerate(issues, start=1):
+        print(f"Generating output {N_issue} of {len(issues)}")
+        yield from stream_issue_openai(issue, n_sentences, client, llm_model, temperature, max_iteration, instructions)
+
+
+def generate_data_openai(issues: list, n_sentences: int, client, llm_model:str, temperature:float, max_iteration:int=5,
+                         stream:bool=False, instructions:str="") -> list:
+    """
+    This function calls the OpenAI API to generate dysfunctional text using as categories the
     issues listed in the "issues" list.
 
     The model output sometimes did not conform to the JSON file format.
     To resolve this, I added a for loop with 'max_iteration' iterations.
     This loop checks if the output is correct, and if not, it re-runs the model.
+    With 'stream=True' the output is checked while it is generated (see 'stream_issue_openai'),
+    so an invalid output is re-run without waiting for the full completion.
 
     Args:
         issues: A list with the issues to include in the synthetic data query engine.
@@ -19,11 +145,17 @@ def generate_data_openai(issues: list, n_sentences: int, client, llm_model:str,
         llm_model: Name of the model.
         temperature: Parameter of the OpenAI model.
         max_iteration: Max number of iteration to try before aborting the function.
+        stream: If True, stream the completions and parse them incrementally.
+        instructions: Additional instructions for the prompt (see 'create_prompt').
 
     Returns:
-        responses: A list with dictionaries containing the genrerated dysfunctional text.
+        responses: A list with dictionaries containing the genrerated dysfunctional text
+            and the issue category used to generate it.
     """
-    
+
+    if stream:
+        return list(stream_data_openai(issues, n_sentences, client, llm_model, temperature, max_iteration, instructions))
+
     # List to store the reposnes
     responses = []
 
@@ -36,35 +168,10 @@ def generate_data_openai(issues: list, n_sentences: int, client, llm_model:str,
         print(f"Generating output {N_issue} of {len(issues)}")
         N_issue += 1
 
-        prompt_1 = f"""
-        Generate examples of dysfunctional and toxic language that might be encountered between couples or 
-        ex-couples who have to continuously interact.
-
-        Each entry should generate a sentence reflecting dysfunctional communication, showcasing various forms
-        of toxicity such as insults, harassment, threats, manipulation, and derogatory remarks.
-    
-        Ensure the sentences are realistic and diverse in terms of content and context.
-        The sentences should refer to this issue category:
-        '{issue}'
-    
-        Provide {n_sentences} sentences.
-        """
-    
-        # The prompt is divided into 2 sub-prompts because
-        # the example of the output format uses Curly brackets {},
-        # and this cannot be done in a f-string.
-        prompt_2 = """
-        Write the output using this format:
-        [
-            {"dysfunctional": "write here the dysfunctional text"},
-            {"dysfunctional": "write here the dysfunctional text"},
-        ]
-        """
-    
-        prompt = prompt_1 + prompt_2
+        prompt = create_prompt(issue, n_sentences, instructions)
 
         num_tries = 0
-        
+
         while True:
             completion = client.chat.completions.create(
                 model=llm_model,
@@ -75,12 +182,14 @@ def generate_data_openai(issues: list, n_sentences: int, client, llm_model:str,
                 temperature=temperature,
             )
             r = completion.choices[0].message.content
-                    
+
             # Check if output is valid JSON
             try:
-                responses += json.loads(r)
+                sentences = parse_sentences(r)
+                # Keep track of the issue category each sentence was generated for
+                responses += [{**sentence, "category": issue} for sentence in sentences]
                 break
-            except json.JSONDecodeError:
+            except ValueError:
                 num_tries += 1
                 if num_tries >= max_iteration:
                     print(" "*4 + f"Invalid JSON format after {max_iteration} retries. Aborting...")
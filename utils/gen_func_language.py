@@ -2,6 +2,9 @@ import json
 import csv
 from pathlib import Path
 
+from utils.load_save import add_source_model, save_parquet
+
+
 def create_prompt(text:str) -> str:
     prompt = f"""
     Below is an instruction that describes a task.
@@ -44,7 +47,8 @@ def pair_text(data_input:list[dict], responses:list) -> list:
     for dysfunctional, functional in zip(data_input, responses):
         paired_text.append({
             'dysfunctional': dysfunctional["dysfunctional"],
-            'functional': functional
+            'functional': functional,
+            'category': dysfunctional.get("category")
         })
 
     return paired_text
@@ -66,12 +70,15 @@ def convert_functional_language(data:list[dict], client_openai, llm_model:str, t
     return pair_text(data, responses)
 
 
-def combine_and_save(data1:list[dict], data2:list[dict], path_json: Path, path_csv: Path):
+def combine_and_save(data1:list[dict], data2:list[dict], path_json: Path, path_csv: Path,
+                     path_parquet: Path=None, source_models:tuple=(None, None)):
     """
-    Combine 2 objects in json fomat into a json file and a csv file.
+    Combine 2 objects in json fomat into a json file and a csv file,
+    and optionally a parquet file.
+    If 'source_models' is given, each row is tagged with the name of the model that generated it.
     """
 
-    data_combined = data1 + data2
+    data_combined = add_source_model(data1, source_models[0]) + add_source_model(data2, source_models[1])
 
     print("Saving combined data into a json file")
     with path_json.open("w") as f:
@@ -84,4 +91,8 @@ def combine_and_save(data1:list[dict], data2:list[dict], path_json: Path, path_c
         writer.writeheader()
         writer.writerows(data_combined)
 
-    return json.dumps(data1 + data2, indent=4)
+    if path_parquet is not None:
+        print("Saving combined data into a parquet file")
+        save_parquet(data_combined, path_parquet)
+
+    return json.dumps(data_combined, indent=4)
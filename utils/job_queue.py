@@ -0,0 +1,290 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils.planner import split_requests
+
+
+def connect(path_queue:Path):
+    """
+    Open a connection to the queue database.
+    Transactions are opened explicitly ('BEGIN IMMEDIATE'), so that several worker
+    processes can lease jobs concurrently without leasing the same job twice.
+    The workers must run on the machine holding the file: WAL mode and the SQLite locks
+    do not work on network filesystems. Spread the work across hosts through the model endpoints instead.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+
+    Returns:
+        A connection to the .db file.
+    """
+    con = sqlite3.connect(path_queue, timeout=30, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    return con
+
+
+def create_queue(path_queue:Path, issues:list, n_sentences:int, batch_size:int, file_name_sql:Path=Path("utils/create_queue.sql"),
+                 reset:bool=False):
+    """
+    Create the queue and add a job for each batch of sentences of each issue.
+    For example, with n_sentences=12 and batch_size=5 each issue gets 3 jobs of 4 sentences (see 'split_requests').
+    A queue that already has jobs is not filled again, since its jobs would be run twice:
+    use 'reset' to delete its jobs and results first.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        issues: A list with the issues to include in the synthetic data.
+        n_sentences: Number of synthetic sentences to generate for each issue.
+        batch_size: Max number of sentences requested in a single job.
+        file_name_sql: Name of the file with the SQL script.
+        reset: If True, delete the jobs and the results already in the queue.
+
+    Returns:
+        The number of jobs added to the queue.
+
+    Raises:
+        RuntimeError: If the queue already has jobs and 'reset' is False.
+    """
+    with open(file_name_sql, 'r') as sql_file:
+        sql_script = sql_file.read()
+
+    jobs = []
+    for issue in issues:
+        for n in split_requests(n_sentences, batch_size):
+            jobs.append((issue, n))
+
+    con = connect(path_queue)
+    con.executescript(sql_script)
+    con.execute("BEGIN IMMEDIATE")
+    n_existing = con.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+    if n_existing and not reset:
+        con.execute("ROLLBACK")
+        con.close()
+        raise RuntimeError(f"The queue {path_queue} already has {n_existing} jobs.")
+    con.execute("DELETE FROM results")
+    con.execute("DELETE FROM jobs")
+    con.executemany("INSERT INTO jobs (issue, n_sentences) VALUES (?, ?)", jobs)
+    con.execute("COMMIT")
+    con.close()
+
+    return len(jobs)
+
+
+def lease_job(path_queue:Path, worker:str, lease_seconds:float=300, max_attempts:int=3) -> dict:
+    """
+    Lease the next job: a pending job, or a leased job whose lease expired (its worker died).
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        worker: Name of the worker.
+        lease_seconds: Seconds after which the job can be leased by another worker, unless renewed with 'heartbeat'.
+        max_attempts: Max number of times a job is leased.
+
+    Returns:
+        A dictionary with the 'id', 'issue' and 'n_sentences' of the job, None if no job is available.
+    """
+    now = time.time()
+    con = connect(path_queue)
+    con.execute("BEGIN IMMEDIATE")
+    # Jobs whose last allowed attempt died with its worker
+    con.execute(
+        "UPDATE jobs SET status = 'failed', worker = NULL, error = 'Lease expired' "
+        "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+        (now, max_attempts))
+    row = con.execute(
+        "SELECT id, issue, n_sentences FROM jobs "
+        "WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ? "
+        "ORDER BY id LIMIT 1",
+        (now, max_attempts)).fetchone()
+    if row is not None:
+        con.execute(
+            "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+            (worker, now + lease_seconds, row[0]))
+    con.execute("COMMIT")
+    con.close()
+
+    if row is None:
+        return None
+    return {"id": row[0], "issue": row[1], "n_sentences": row[2]}
+
+
+def heartbeat(path_queue:Path, job_id:int, worker:str, lease_seconds:float=300) -> bool:
+    """
+    Renew the lease of a job.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        job_id: Id of the job.
+        worker: Name of the worker.
+        lease_seconds: Seconds from now after which the lease expires.
+
+    Returns:
+        True if the worker still holds the lease, False if it was lost.
+    """
+    con = connect(path_queue)
+    cursor = con.execute(
+        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+        (time.time() + lease_seconds, job_id, worker))
+    con.close()
+
+    return cursor.rowcount == 1
+
+
+def complete_job(path_queue:Path, job_id:int, worker:str, responses:list, model:str) -> bool:
+    """
+    Store the sentences generated for a job and mark it as done.
+    Nothing is stored if the worker lost the lease, since another worker is running the same job.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        job_id: Id of the job.
+        worker: Name of the worker.
+        responses: A list with dictionaries containing the generated dysfunctional text and its issue category.
+        model: Name of the model that generated the text.
+
+    Returns:
+        True if the results were stored.
+    """
+    con = connect(path_queue)
+    con.execute("BEGIN IMMEDIATE")
+    cursor = con.execute(
+        "UPDATE jobs SET status = 'done', lease_expires = NULL WHERE id = ? AND worker = ? AND status = 'leased'",
+        (job_id, worker))
+    if cursor.rowcount == 1:
+        con.executemany(
+            "INSERT INTO results (job_id, dysfunctional, category, model, worker) VALUES (?, ?, ?, ?, ?)",
+            [(job_id, r["dysfunctional"], r.get("category"), model, worker) for r in responses])
+    con.execute("COMMIT")
+    con.close()
+
+    return cursor.rowcount == 1
+
+
+def fail_job(path_queue:Path, job_id:int, worker:str, error:str, max_attempts:int=3):
+    """
+    Release a job that failed: it goes back to 'pending', or to 'failed' after 'max_attempts' attempts.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        job_id: Id of the job.
+        worker: Name of the worker.
+        error: Description of the error.
+        max_attempts: Max number of times a job is leased.
+    """
+    con = connect(path_queue)
+    con.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "worker = NULL, lease_expires = NULL, error = ? "
+        "WHERE id = ? AND worker = ? AND status = 'leased'",
+        (max_attempts, error, job_id, worker))
+    con.close()
+
+
+def queue_status(path_queue:Path) -> dict:
+    """
+    Count the jobs in each status.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+
+    Returns:
+        A dictionary with the status as key and the number of jobs as value.
+    """
+    con = connect(path_queue)
+    rows = con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+    con.close()
+
+    return dict(rows)
+
+
+def _keep_alive(path_queue:Path, job_id:int, worker:str, lease_seconds:float, interval:float, stop:threading.Event):
+    while not stop.wait(interval):
+        if not heartbeat(path_queue, job_id, worker, lease_seconds):
+            break
+
+
+def run_worker(path_queue:Path, worker:str, generate, model:str, lease_seconds:float=300,
+               heartbeat_interval:float=60, max_attempts:int=3, poll_interval:float=5):
+    """
+    Lease jobs from the queue and run them until no job is left.
+    While a job runs, a thread renews its lease every 'heartbeat_interval' seconds,
+    so the lease expires only if the worker process dies.
+    A job that raises an error or returns no sentences is released for another attempt.
+
+    'generate' is a function taking an issue and a number of sentences, and returning
+    the generated sentences, for example:
+        lambda issue, n: generate_data_ollama([issue], n, llm_model, client=ollama.Client(host=endpoint))
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+        worker: Name of the worker, unique among the running workers.
+        generate: Function generating the sentences of a job.
+        model: Name of the model, stored with the results.
+        lease_seconds: Seconds after which the lease of a job expires, unless renewed.
+        heartbeat_interval: Seconds between two renewals of the lease.
+        max_attempts: Max number of times a job is leased.
+        poll_interval: Seconds to wait when all the remaining jobs are leased by other workers.
+
+    Returns:
+        The number of jobs completed by this worker.
+    """
+    n_done = 0
+
+    while True:
+        job = lease_job(path_queue, worker, lease_seconds, max_attempts)
+        if job is None:
+            status = queue_status(path_queue)
+            if status.get("pending", 0) == 0 and status.get("leased", 0) == 0:
+                return n_done
+            # Other workers are running the remaining jobs, wait in case their leases expire
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker}] Job {job['id']}: {job['n_sentences']} sentences for '{job['issue']}'")
+        stop = threading.Event()
+        keep_alive = threading.Thread(
+            target=_keep_alive,
+            args=(path_queue, job["id"], worker, lease_seconds, heartbeat_interval, stop),
+            daemon=True)
+        keep_alive.start()
+
+        try:
+            responses = generate(job["issue"], job["n_sentences"])
+        except Exception as e:
+            responses = None
+            error = repr(e)
+        else:
+            error = "No sentences generated"
+        finally:
+            stop.set()
+            keep_alive.join()
+
+        if responses:
+            if complete_job(path_queue, job["id"], worker, responses, model):
+                n_done += 1
+            else:
+                print(f"[{worker}] Lease of job {job['id']} lost, results discarded")
+        else:
+            print(f"[{worker}] Job {job['id']} failed: {error}")
+            fail_job(path_queue, job["id"], worker, error, max_attempts)
+
+
+def merge_results(path_queue:Path) -> list:
+    """
+    Collect the sentences generated by all the workers, in the order of the jobs.
+
+    Args:
+        path_queue: Path to the .db file of the queue.
+
+    Returns:
+        A list with dictionaries containing the generated dysfunctional text, its issue category
+        and the model that generated it, in the format written by 'utils.load_save.save_files'.
+    """
+    con = connect(path_queue)
+    rows = con.execute(
+        "SELECT dysfunctional, category, model FROM results ORDER BY job_id, id").fetchall()
+    con.close()
+
+    return [{"dysfunctional": row[0], "category": row[1], "model": row[2]} for row in rows]
@@ -1,6 +1,9 @@
 from pathlib import Path
 import json
 import csv
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 def import_json(file_path:Path):
@@ -10,27 +13,144 @@ def import_json(file_path:Path):
     return data
 
 
-def save_files(responses:list, path_json:Path, path_csv:Path):
+def add_source_model(responses:list, source_model:str=None) -> list:
+    """
+    Add the name of the model that generated the data to each row.
+
+    Args:
+        responses: A list with the generated data.
+        source_model: Name of the model, None to leave the rows unchanged.
+
+    Returns:
+        A list with the rows, with the key 'model' if 'source_model' is given.
+    """
+    if source_model is None:
+        return responses
+    return [{**row, "model": source_model} for row in responses]
+
+
+def save_parquet(responses:list, path_parquet:Path, embeddings:list=None):
+    """
+    Save the synthetic data into a Parquet file, with the columns:
+    dysfunctional, functional, category, model and, if given, embedding.
+    The embedding column is a fixed-size list of float32, so that once the file is read
+    it converts to a single numpy matrix without a further copy (see 'parquet_embeddings').
+
+    Args:
+        responses: A list with the generated data to store into the file.
+        path_parquet: Path for the parquet file.
+        embeddings: List with the embedding for the dysfunctional text of each row, or None.
+
+    Returns:
+        None, save a parquet file.
+    """
+    columns = {
+        "dysfunctional": pa.array([row["dysfunctional"] for row in responses], type=pa.string()),
+        "functional": pa.array([row.get("functional") for row in responses], type=pa.string()),
+        "category": pa.array([row.get("category") for row in responses], type=pa.string()),
+        "model": pa.array([row.get("model") for row in responses], type=pa.string()),
+    }
+
+    if embeddings is not None:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(embeddings) != len(responses):
+            raise ValueError(f"{len(embeddings)} embeddings for {len(responses)} rows")
+        if len(embeddings) == 0:
+            # The size of the embeddings is unknown without rows
+            columns["embedding"] = pa.array([], type=pa.list_(pa.float32()))
+        else:
+            columns["embedding"] = pa.FixedSizeListArray.from_arrays(
+                pa.array(embeddings.reshape(-1)), embeddings.shape[1])
+
+    pq.write_table(pa.table(columns), path_parquet)
+
+
+def read_parquet_table(file_path:Path) -> pa.Table:
+    """
+    Read a Parquet file written by 'save_parquet' as an Arrow table.
+    Parquet pages are encoded and compressed, so the columns are decoded into memory:
+    the table is not a view on the file, even when the file is memory-mapped.
+
+    Args:
+        file_path: Path to the parquet file.
+
+    Returns:
+        An Arrow table.
+    """
+    return pq.read_table(file_path)
+
+
+def parquet_embeddings(table:pa.Table) -> np.ndarray:
+    """
+    Return the embedding column of an Arrow table as a matrix.
+    When the column is stored in a single chunk the matrix is a view on the decoded Arrow buffer,
+    otherwise the chunks are concatenated first.
+
+    Args:
+        table: An Arrow table with an 'embedding' column of fixed-size lists.
+
+    Returns:
+        A (read-only) matrix with an embedding for each row.
+    """
+    column = table.column("embedding")
+    if len(column) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    values = column.flatten().to_numpy(zero_copy_only=True)
+    return values.reshape(-1, column.type.list_size)
+
+
+def import_parquet(file_path:Path) -> tuple[list, np.ndarray]:
+    """
+    Load a Parquet file written by 'save_parquet', in the same format used by
+    'utils.embeddings.insert_embeddings'.
+
+    Args:
+        file_path: Path to the parquet file.
+
+    Returns:
+        data: A list with dictionaries containing the text columns of each row.
+        embeddings: A matrix with the embedding of each row, None if the file has no embeddings.
+    """
+    print(f"Loading file: {file_path}")
+    table = read_parquet_table(file_path)
+
+    text_columns = [name for name in table.column_names if name != "embedding"]
+    data = table.select(text_columns).to_pylist()
+    embeddings = parquet_embeddings(table) if "embedding" in table.column_names else None
+
+    return data, embeddings
+
+
+def save_files(responses:list, path_json:Path, path_csv:Path, path_parquet:Path=None, source_model:str=None):
     """
     This function saves the generated synthetic data into a
-    json file and a csv file.
+    json file and a csv file, and optionally a parquet file.
 
     Args:
         responses: A list with the generated data to store into files.
         path_json: Path for the json file.
         path_csv: Path for the csv file.
+        path_parquet: Path for the parquet file, None to skip it.
+        source_model: Name of the model that generated the data, stored in the 'model' column.
 
     Returns:
         None, save a json file and a csv file.
     """
 
+    responses = add_source_model(responses, source_model)
+
     print("Saving json file")
     with path_json.open("w") as f:
         json.dump(responses, f, indent=4)
-    
+
     print("Saving csv file")
     keys = responses[0].keys()
     with path_csv.open("w", newline='') as f:
         writer = csv.DictWriter(f, fieldnames=keys)
         writer.writeheader()
         writer.writerows(responses)
+
+    if path_parquet is not None:
+        print("Saving parquet file")
+        save_parquet(responses, path_parquet)
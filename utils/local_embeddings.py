@@ -0,0 +1,155 @@
+import json
+import sqlite3
+from pathlib import Path
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+
+def text_features(texts:list[str], n_features:int=2**12):
+    """
+    Compute cheap local features for a list of texts: hashed character n-grams.
+    The features do not depend on a vocabulary, so no network or fitted state is needed.
+
+    Args:
+        texts: List with the text.
+        n_features: Number of features (size of the hashing space).
+
+    Returns:
+        A sparse matrix with a row of features for each text.
+    """
+    vectorizer = HashingVectorizer(
+        analyzer="char_wb",
+        ngram_range=(2, 4),
+        n_features=n_features,
+        alternate_sign=False,
+        norm="l2")
+    return vectorizer.transform(texts)
+
+
+def train_local_embedder(path_db:Path, path_model:Path, alpha:float=0.1, n_features:int=2**12) -> dict:
+    """
+    Train offline a linear projection from the local features ('text_features') to the
+    remote embeddings stored in the database, e.g. those of "text-embedding-3-small".
+
+    The projection is a ridge regression. It is solved in its dual form (an n_examples x n_examples system)
+    when there are fewer examples than features, and in its primal form (an n_features x n_features system)
+    otherwise, so the memory used does not grow with the square of the number of examples.
+
+    Args:
+        path_db: Path to the .db file with the examples and their embeddings.
+        path_model: Path to the .npz file in which to save the projection.
+        alpha: Regularization strength of the ridge regression.
+        n_features: Number of local features.
+
+    Returns:
+        embedder: A dictionary with the projection (see 'load_local_embedder').
+    """
+    conn = sqlite3.connect(path_db)
+    rows = conn.execute('SELECT dysfunctional, embedding FROM examples').fetchall()
+    conn.close()
+
+    X = text_features([row[0] for row in rows], n_features)
+    Y = np.array([json.loads(row[1]) for row in rows])
+
+    # Ridge regression with intercept:
+    # W = X^T (X X^T + alpha I)^-1 (Y - mean(Y)) = (X^T X + alpha I)^-1 X^T (Y - mean(Y))
+    bias = Y.mean(axis=0)
+    if X.shape[0] <= n_features:
+        K = (X @ X.T).toarray()
+        dual_coef = np.linalg.solve(K + alpha * np.eye(K.shape[0]), Y - bias)
+        weights = np.asarray(X.T @ dual_coef)
+    else:
+        G = (X.T @ X).toarray()
+        weights = np.linalg.solve(G + alpha * np.eye(n_features), np.asarray(X.T @ (Y - bias)))
+
+    embedder = {
+        "weights": weights.astype(np.float32),
+        "bias": bias.astype(np.float32),
+        "n_features": n_features
+    }
+    np.savez(path_model, **embedder)
+
+    return embedder
+
+
+def load_local_embedder(path_model:Path) -> dict:
+    """
+    Load a projection trained with 'train_local_embedder'.
+
+    Args:
+        path_model: Path to the .npz file with the projection.
+
+    Returns:
+        embedder: A dictionary with the projection weights, the bias and the number of local features.
+    """
+    with np.load(path_model) as model:
+        return {
+            "weights": model["weights"],
+            "bias": model["bias"],
+            "n_features": int(model["n_features"])
+        }
+
+
+def get_local_embeddings(texts:list[str], embedder:dict) -> np.ndarray:
+    """
+    Generate embeddings for a list of texts with the local projection.
+    It runs on CPU and does not use the network.
+
+    Args:
+        texts: List with the text.
+        embedder: The projection returned by 'load_local_embedder'.
+
+    Returns:
+        A matrix with the normalized vector embedding of each text.
+    """
+    X = text_features(texts, embedder["n_features"])
+    embeddings = np.asarray(X @ embedder["weights"]) + embedder["bias"]
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def get_local_embedding(text:str, embedder:dict) -> list:
+    """
+    Generate the embedding of a text with the local projection.
+
+    Args:
+        text: Text to use to generated the vector embedding.
+        embedder: The projection returned by 'load_local_embedder'.
+
+    Returns:
+        A list with the vector embedding.
+    """
+    return get_local_embeddings([text], embedder)[0].tolist()
+
+
+def add_local_embedding_column(con):
+    """
+    Add the 'local_embedding' column to the 'examples' table, if missing.
+
+    Args:
+        con: An open connection to the .db file.
+    """
+    columns = [row[1] for row in con.execute("PRAGMA table_info(examples)")]
+    if "local_embedding" not in columns:
+        con.execute("ALTER TABLE examples ADD COLUMN local_embedding BLOB")
+
+
+def insert_local_embeddings(path_db:Path, embedder:dict):
+    """
+    Re-embed all the examples in the database with the local projection
+    and store the result in the 'local_embedding' column.
+
+    Args:
+        path_db: Path to the .db file with the examples.
+        embedder: The projection returned by 'load_local_embedder'.
+    """
+    con = sqlite3.connect(path_db)
+    with con:
+        add_local_embedding_column(con)
+        rows = con.execute('SELECT id, dysfunctional FROM examples').fetchall()
+        embeddings = get_local_embeddings([row[1] for row in rows], embedder)
+        for row, emb in zip(rows, embeddings):
+            con.execute(
+                "UPDATE examples SET local_embedding = ? WHERE id = ?",
+                (json.dumps(emb.tolist()), row[0])
+            )
+    con.close()
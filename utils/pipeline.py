@@ -0,0 +1,184 @@
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+
+from utils.gen_func_language import create_prompt, call_client, pair_text
+from utils.embeddings import get_embeddings, add_category_column, insert_examples
+
+# Marks the end of the rows in a queue
+_DONE = object()
+
+
+def _produce(name:str, source, out_queue:queue.Queue, failed:threading.Event, source_errors:dict):
+    """
+    Put the rows generated by a source into the queue, tagged with the name of the source.
+    An error of the source stops only this source: its rows already in the queue are kept.
+    """
+    try:
+        for row in source:
+            if failed.is_set():
+                break
+            out_queue.put((name, row))
+    except Exception as e:
+        print(f"Source {name} failed, its other rows are not generated: {e!r}")
+        source_errors[name] = e
+
+
+def _convert(in_queue:queue.Queue, out_queue:queue.Queue, client, llm_model:str, temperature:float,
+             failed:threading.Event, errors:list):
+    """
+    Convert the rows of the input queue into functional language and put them into the output queue.
+    """
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            break
+        if failed.is_set():
+            # Keep consuming, so that the producers are not blocked on a full queue
+            continue
+        name, row = item
+        try:
+            functional = call_client(create_prompt(row), client, llm_model, temperature)
+            out_queue.put((name, pair_text([row], [functional])[0]))
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+
+
+def _embed(in_queue:queue.Queue, results:dict, embeddings:dict, emb_model:str, client, path_db:Path, batch_size:int,
+           failed:threading.Event, errors:list):
+    """
+    Embed the rows of the input queue and insert them into the database, as soon as 'batch_size'
+    rows are available (or fewer, if no other row is waiting in the queue).
+    Each batch is embedded with a single request and committed in a single transaction,
+    on a connection opened once for the whole stage.
+    """
+    con = None
+    try:
+        con = sqlite3.connect(path_db)
+        with con:
+            add_category_column(con)
+        _embed_batches(in_queue, results, embeddings, emb_model, client, con, batch_size, failed, errors)
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+        # Drain the queue, so that the converters are not blocked on a full queue
+        while in_queue.get() is not _DONE:
+            pass
+    finally:
+        if con is not None:
+            con.close()
+
+
+def _embed_batches(in_queue:queue.Queue, results:dict, embeddings:dict, emb_model:str, client, con, batch_size:int,
+                   failed:threading.Event, errors:list):
+    done = False
+    while not done:
+        batch = [in_queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(in_queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is _DONE:
+            batch.pop()
+            done = True
+        if failed.is_set() or not batch:
+            continue
+
+        rows = [row for _, row in batch]
+        try:
+            batch_embeddings = get_embeddings([row["dysfunctional"] for row in rows], model=emb_model, client=client)
+            with con:
+                insert_examples(con, rows, batch_embeddings)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+            continue
+        for (name, row), embedding in zip(batch, batch_embeddings):
+            results[name].append(row)
+            embeddings[name].append(embedding)
+
+
+def run_streaming_pipeline(sources:dict, client, llm_model:str, temperature:float, emb_model:str, path_db:Path,
+                           n_convert_workers:int=4, queue_size:int=32, emb_batch_size:int=16,
+                           source_errors:dict=None, embeddings:dict=None) -> dict:
+    """
+    Run generation, conversion into functional language and embedding as a streaming pipeline.
+
+    Each source runs in its own thread, so independent sources (e.g. OpenAI and Ollama) generate concurrently.
+    The rows flow through bounded queues to 'n_convert_workers' threads that convert them into functional
+    language, and then to a thread that embeds them and inserts them into the database.
+    Every stage starts as soon as the first row is available, so the total time approaches the time
+    of the slowest stage instead of the sum of all of them, while the bounded queues stop
+    a fast stage from running too far ahead of a slow one.
+
+    If a source fails (e.g. the Ollama server is not running), the other sources go on and the rows
+    it generated before the error are kept; the error is stored in 'source_errors'.
+    An error in the conversion or in the embedding stops the whole pipeline and is raised.
+
+    'sources' is a dictionary with a name for each source and an iterable yielding the generated rows, e.g.
+        {
+            "gpt-3.5-turbo": stream_data_openai(...),
+            "dolphin-mistral": stream_data_ollama(...)
+        }
+
+    Args:
+        sources: Dictionary with the sources of the rows.
+        client: A client for the OpenAI API.
+        llm_model: Name of the model used to convert into functional language.
+        temperature: Parameter of the OpenAI model.
+        emb_model: Name of the model for the embeddings.
+        path_db: Path to the .db file in which insert the text and embeddings.
+        n_convert_workers: Number of threads converting into functional language.
+        queue_size: Max number of rows waiting between two stages.
+        emb_batch_size: Max number of rows embedded and inserted together.
+        source_errors: Dictionary in which the error of each failed source is stored, with the name of the source as key.
+        embeddings: Dictionary in which the embeddings of the rows of each source are stored,
+            with the name of the source as key, in the same order as the rows in 'results'.
+
+    Returns:
+        results: A dictionary with the name of each source as key and the list with its rows
+            (dysfunctional text, functional version and issue category) as value.
+    """
+    generated_queue = queue.Queue(maxsize=queue_size)
+    converted_queue = queue.Queue(maxsize=queue_size)
+    results = {name: [] for name in sources}
+    failed = threading.Event()
+    errors = []
+    if source_errors is None:
+        source_errors = {}
+    if embeddings is None:
+        embeddings = {}
+    embeddings.update({name: [] for name in sources})
+
+    producers = [
+        threading.Thread(target=_produce, args=(name, source, generated_queue, failed, source_errors))
+        for name, source in sources.items()
+    ]
+    converters = [
+        threading.Thread(target=_convert, args=(generated_queue, converted_queue, client, llm_model, temperature, failed, errors))
+        for _ in range(n_convert_workers)
+    ]
+    embedder = threading.Thread(
+        target=_embed,
+        args=(converted_queue, results, embeddings, emb_model, client, path_db, emb_batch_size, failed, errors))
+
+    for thread in producers + converters + [embedder]:
+        thread.start()
+
+    # Close each stage once the previous one is finished
+    for thread in producers:
+        thread.join()
+    for _ in converters:
+        generated_queue.put(_DONE)
+    for thread in converters:
+        thread.join()
+    converted_queue.put(_DONE)
+    embedder.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
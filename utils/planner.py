@@ -0,0 +1,231 @@
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Forms of toxicity listed in the generation prompts, one is given as focus to each extra request of an issue
+FOCUS = ["insults", "harassment", "threats", "manipulation", "derogatory remarks"]
+MAX_AVOID = 30 # Max number of accepted sentences listed in the prompt of a top-up request
+
+
+def split_requests(n_sentences:int, max_per_request:int) -> list[int]:
+    """
+    Split a number of sentences into the fewest requests of at most 'max_per_request' sentences,
+    with sizes as equal as possible.
+    For example, 45 sentences with max_per_request=20 give [15, 15, 15] instead of [20, 20, 5].
+
+    Args:
+        n_sentences: Number of sentences to request.
+        max_per_request: Max number of sentences in a single request.
+
+    Returns:
+        A list with the number of sentences of each request.
+    """
+    if n_sentences <= 0:
+        return []
+    n_requests = math.ceil(n_sentences / max_per_request)
+    size, remainder = divmod(n_sentences, n_requests)
+    return [size + 1] * remainder + [size] * (n_requests - remainder)
+
+
+def normalize_sentence(text:str) -> str:
+    """
+    Normalize a sentence to detect duplicates: lowercase, without punctuation and extra spaces.
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def request_instructions(n_request:int, accepted:list) -> str:
+    """
+    Create the additional instructions that make a request differ from the other requests of the same issue.
+    With the same prompt (and temperature 0) the requests of an issue would return the same sentences,
+    so each request after the first focuses on a different form of toxicity, and the requests sent
+    after the first round list the sentences already accepted (the last 'MAX_AVOID'), asking not to repeat them.
+
+    Args:
+        n_request: Number of requests already sent for the issue.
+        accepted: The sentences already accepted for the issue.
+
+    Returns:
+        A string with the instructions, empty for the first request.
+    """
+    lines = []
+    if n_request > 0:
+        lines.append(f"Focus mostly on {FOCUS[(n_request - 1) % len(FOCUS)]}.")
+    if accepted:
+        lines.append("Do not repeat or paraphrase these sentences, they were already generated:")
+        lines += [f"- {sentence['dysfunctional']}" for sentence in accepted[-MAX_AVOID:]]
+    # Same indentation as the lines of the prompt
+    return "\n    ".join(lines)
+
+
+def add_unique_sentences(accepted:list, seen:set, sentences:list, target:int) -> list:
+    """
+    Add to the sentences accepted for an issue the new sentences that are not duplicates,
+    until the target is reached.
+
+    Args:
+        accepted: The sentences already accepted for the issue, updated in place.
+        seen: The normalized text of the accepted sentences (see 'normalize_sentence'), updated in place.
+        sentences: The generated sentences.
+        target: Number of sentences to accept for the issue.
+
+    Returns:
+        A list with the sentences added.
+    """
+    added = []
+    for sentence in sentences:
+        # Skip malformed sentences, e.g. {"dysfunctional": null}
+        text = sentence.get("dysfunctional") if isinstance(sentence, dict) else None
+        if not isinstance(text, str):
+            continue
+        key = normalize_sentence(text)
+        if not key or key in seen or len(accepted) >= target:
+            continue
+        seen.add(key)
+        accepted.append(sentence)
+        added.append(sentence)
+    return added
+
+
+def generate_to_target(issues:list, target:int, generate, max_per_request:int=25, max_workers:int=4,
+                       max_rounds:int=5, accepted:list=None) -> list:
+    """
+    Generate 'target' unique sentences for each issue.
+
+    The target of each issue is split into requests of at most 'max_per_request' sentences
+    (see 'split_requests'), so that no request exceeds the output-token limit of the model,
+    and the requests run concurrently on 'max_workers' threads.
+    The unique sentences accepted for each issue are counted: the models return fewer sentences
+    than requested, duplicates or invalid JSON, so new requests are sent only for the shortfall.
+    The rounds are scheduled per issue: as soon as all the requests of a round of an issue
+    have finished, the requests for its shortfall are submitted, without waiting for the other issues
+    (they start once a thread is free, after the requests already submitted).
+    An issue stops when it reaches its target, when one of its rounds adds no sentence,
+    or after 'max_rounds' rounds.
+    The requests of an issue get different instructions (see 'request_instructions'),
+    so that they do not return the same sentences.
+
+    'generate' is a function taking an issue, a number of sentences and the instructions
+    of the request, and returning the generated sentences, for example:
+        lambda issue, n, instructions: generate_data_openai([issue], n, client, llm_model, temperature,
+                                                            instructions=instructions)
+
+    Args:
+        issues: A list with the issues to include in the synthetic data.
+        target: Number of unique sentences to generate for each issue.
+        generate: Function generating the sentences for an issue.
+        max_per_request: Max number of sentences in a single request.
+        max_workers: Number of requests running at the same time.
+        max_rounds: Max number of rounds of requests for each issue.
+        accepted: Sentences already generated (e.g. by a batch job), with their 'category',
+            counted towards the target of their issue.
+
+    Returns:
+        responses: A list with dictionaries containing the generated dysfunctional text
+            and the issue category used to generate it, grouped by issue.
+    """
+    accepted_issue = {issue: [] for issue in issues}
+    seen = {issue: set() for issue in issues}
+    for sentence in accepted or []:
+        if sentence.get("category") in accepted_issue:
+            issue = sentence["category"]
+            add_unique_sentences(accepted_issue[issue], seen[issue], [sentence], target)
+    # The first request of an issue has no focus, unless the issue has sentences already
+    n_requests = {issue: int(bool(accepted_issue[issue])) for issue in issues}
+    n_rounds = {issue: 0 for issue in issues}
+    n_added = {issue: 0 for issue in issues}
+    n_pending = {issue: 0 for issue in issues}
+    futures = {}
+
+    def submit_round(issue):
+        shortfall = target - len(accepted_issue[issue])
+        n_rounds[issue] += 1
+        n_added[issue] = 0
+        for n in split_requests(shortfall, max_per_request):
+            instructions = request_instructions(n_requests[issue], accepted_issue[issue])
+            n_requests[issue] += 1
+            n_pending[issue] += 1
+            futures[executor.submit(generate, issue, n, instructions)] = issue
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for issue in issues:
+            if len(accepted_issue[issue]) < target:
+                submit_round(issue)
+        print(f"{len(futures)} requests for {sum(target - len(accepted_issue[issue]) for issue in issues)} missing sentences")
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                issue = futures.pop(future)
+                n_pending[issue] -= 1
+                try:
+                    sentences = future.result()
+                except Exception as e:
+                    print(" "*4 + f"Request for '{issue}' failed: {e!r}")
+                else:
+                    n_added[issue] += len(add_unique_sentences(accepted_issue[issue], seen[issue], sentences, target))
+
+                # Top-up as soon as the round of this issue is finished
+                shortfall = target - len(accepted_issue[issue])
+                if n_pending[issue] > 0 or shortfall <= 0:
+                    continue
+                if n_added[issue] == 0:
+                    print(" "*4 + f"No new sentences for '{issue}' in round {n_rounds[issue]}. Stopping...")
+                elif n_rounds[issue] < max_rounds:
+                    print(" "*4 + f"Round {n_rounds[issue] + 1} for '{issue}': {shortfall} missing sentences")
+                    submit_round(issue)
+
+    missing = {issue: target - len(accepted_issue[issue]) for issue in issues if len(accepted_issue[issue]) < target}
+    if missing:
+        print(f"{len(missing)} issues did not reach the target of {target} sentences: {missing}")
+
+    return [sentence for issue in issues for sentence in accepted_issue[issue]]
+
+
+def stream_to_target(issues:list, target:int, stream_issue, max_per_request:int=25, max_rounds:int=5):
+    """
+    Streaming version of 'generate_to_target', for the streaming pipeline: the requests run one at a time
+    and each unique sentence is yielded as soon as it is received.
+    The target of each issue is split into requests of at most 'max_per_request' sentences,
+    and the shortfall of an issue is requested again as soon as its requests have finished.
+
+    'stream_issue' is a function taking an issue, a number of sentences and the instructions
+    of the request, and yielding the generated sentences, for example:
+        lambda issue, n, instructions: stream_issue_openai(issue, n, client, llm_model, temperature,
+                                                           instructions=instructions)
+
+    Args:
+        issues: A list with the issues to include in the synthetic data.
+        target: Number of unique sentences to generate for each issue.
+        stream_issue: Function streaming the sentences for an issue.
+        max_per_request: Max number of sentences in a single request.
+        max_rounds: Max number of rounds of requests for each issue.
+
+    Yields:
+        A dictionary with a generated dysfunctional text and its issue category.
+    """
+    for n_issue, issue in enumerate(issues, 1):
+        print(f"Generating output {n_issue} of {len(issues)}")
+        accepted = []
+        seen = set()
+        n_request = 0
+
+        for n_round in range(1, max_rounds + 1):
+            shortfall = target - len(accepted)
+            if shortfall <= 0:
+                break
+            if n_round > 1:
+                print(" "*4 + f"Round {n_round} for '{issue}': {shortfall} missing sentences")
+
+            n_added = 0
+            for n in split_requests(shortfall, max_per_request):
+                instructions = request_instructions(n_request, accepted)
+                n_request += 1
+                for sentence in stream_issue(issue, n, instructions):
+                    for added in add_unique_sentences(accepted, seen, [sentence], target):
+                        n_added += 1
+                        yield added
+
+            if n_added == 0:
+                print(" "*4 + f"No new sentences for '{issue}' in round {n_round}. Stopping...")
+                break
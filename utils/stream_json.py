@@ -0,0 +1,131 @@
+import json
+
+
+class InvalidJSONStream(ValueError):
+    """
+    Raised when a streamed model output can no longer become a valid JSON array of objects.
+    """
+
+
+def is_sentence(obj) -> bool:
+    """
+    Check that an object of the model output is a generated sentence: {"dysfunctional": "some text"}.
+    """
+    return isinstance(obj, dict) and isinstance(obj.get("dysfunctional"), str)
+
+
+def parse_sentences(text:str) -> list[dict]:
+    """
+    Parse the full model output: a JSON array of sentences (see 'is_sentence').
+
+    Args:
+        text: The model output.
+
+    Returns:
+        A list with the dictionaries of the sentences.
+
+    Raises:
+        ValueError: If the output is missing (None), not valid JSON or not an array of sentences
+            ('json.JSONDecodeError' is a subclass of ValueError).
+    """
+    if not isinstance(text, str):
+        raise ValueError("The output has no text")
+    sentences = json.loads(text)
+    if not isinstance(sentences, list) or not all(is_sentence(s) for s in sentences):
+        raise ValueError("The output is not a JSON array of sentences")
+    return sentences
+
+
+class JSONArrayParser:
+    """
+    Incremental parser for a JSON array of sentences (see 'is_sentence'), for example:
+        [
+            {"dysfunctional": "write here the dysfunctional text"},
+            {"dysfunctional": "write here the dysfunctional text"}
+        ]
+
+    The model output is passed chunk by chunk with 'feed', which yields the objects
+    completed by that chunk. This way each object can be used as soon as it is received,
+    and an invalid output is detected as soon as it goes wrong, without waiting for the
+    end of the generation. The objects completed before the error are yielded before
+    InvalidJSONStream is raised, also when they are in the same chunk.
+    Commas between objects are optional and a trailing comma is accepted,
+    since the models frequently get them wrong.
+    """
+
+    def __init__(self):
+        self.state = "start"  # "start", "array", "object" or "end"
+        self.buffer = ""      # Text of the object currently parsed
+        self.depth = 0        # Depth of the curly brackets in the current object
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk:str):
+        """
+        Parse a chunk of the model output.
+
+        Args:
+            chunk: Next piece of text of the model output.
+
+        Yields:
+            Each object completed in this chunk, as soon as its closing bracket is parsed.
+
+        Raises:
+            InvalidJSONStream: If the output is not a valid JSON array of objects.
+        """
+        for char in chunk:
+            if self.state == "object":
+                self.buffer += char
+                if self.in_string:
+                    if self.escape:
+                        self.escape = False
+                    elif char == "\\":
+                        self.escape = True
+                    elif char == '"':
+                        self.in_string = False
+                elif char == '"':
+                    self.in_string = True
+                elif char == "{":
+                    self.depth += 1
+                elif char == "}":
+                    self.depth -= 1
+                    if self.depth == 0:
+                        yield self._decode_object()
+            elif char.isspace():
+                continue
+            elif self.state == "start":
+                if char != "[":
+                    raise InvalidJSONStream(f"Expected '[' at the start of the output, got {char!r}")
+                self.state = "array"
+            elif self.state == "array":
+                if char == "{":
+                    self.state = "object"
+                    self.buffer = char
+                    self.depth = 1
+                elif char == "]":
+                    self.state = "end"
+                elif char != ",":
+                    raise InvalidJSONStream(f"Expected an object in the array, got {char!r}")
+            else:
+                raise InvalidJSONStream(f"Unexpected {char!r} after the end of the array")
+
+    def close(self):
+        """
+        Check that the whole array has been received.
+
+        Raises:
+            InvalidJSONStream: If the output ended before the end of the array.
+        """
+        if self.state != "end":
+            raise InvalidJSONStream("The output ended before the end of the JSON array")
+
+    def _decode_object(self) -> dict:
+        try:
+            obj = json.loads(self.buffer)
+        except json.JSONDecodeError as e:
+            raise InvalidJSONStream(f"Invalid object in the array: {e}") from e
+        if not is_sentence(obj):
+            raise InvalidJSONStream(f"The object is not a sentence: {self.buffer}")
+        self.state = "array"
+        self.buffer = ""
+        return obj